@@ -4,18 +4,35 @@
 import sys as _sys
 _sys.path = _sys.path[1:]
 
-from . import download
-from . import extract
+import importlib as _importlib
 
-from . import unit
-from .unit import UnitConfig, Unit
+# Everything is imported on first use, so that e.g. the command line only loads what the subcommand needs
+_mLazy = {
+        'UnitConfig': 'unit', 'Unit': 'unit',
+        'TaskRepoFileList': 'repo',
+        'TaskSyncIndex': 'repo', 'TaskIndexPackage': 'repo', 'TaskCleanupIndex': 'repo', 'TaskPackIndex': 'repo',
+        'TaskRepoAdd': 'repo',
+        'RepoIndex': 'index',
+        'RepoModel': 'repomodel',
+        'ObjectStore': 'cas',
+        'openArtifactStore': 'artifact',
+        'JobServer': 'jobserver',
+        'fetchAll': 'download',
+        'BuildGraph': 'scheduler', 'runBuild': 'scheduler',
+        'getVersionString': 'ver', 'parseVersionString': 'ver', 'vercmp': 'ver',
+        'VersionKey': 'ver', 'getVersionKey': 'ver', 'sortVersions': 'ver', 'newest': 'ver',
+        'logger': 'logging',
+        }
+# Every submodule, since the ones imported by others used to show up as attributes anyway
+_aModule = ('artifact', 'build', 'cas', 'catalog', 'cmd', 'download', 'extract', 'index', 'jobserver', 'latest', 'logging', 'main',
+        'pack', 'preproc', 'repo', 'repomodel', 'scheduler', 'stream', 'task', 'tidy', 'unit', 'ver')
 
-from . import repo
-from .repo import TaskExtractDB, TaskMakeRepoDesc, TaskRepoFileList, TaskCleanupRepo, TaskPackDB
-from .repo import TaskRepoAdd
+def __getattr__(name):
+    if name in _mLazy:
+        return getattr(_importlib.import_module('.{}'.format(_mLazy[name]), __name__), name)
+    if name in _aModule:
+        return _importlib.import_module('.{}'.format(name), __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
-from . import ver
-from .ver import getVersionString, parseVersionString, vercmp
-
-from . import logging
-from .logging import logger
+def __dir__():
+    return sorted(set(globals()) | set(_mLazy) | set(_aModule))
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import urllib.error
+import urllib.parse
+import urllib.request
+from pathlib import Path
+
+from .stream import SIZE_CHUNK
+
+# Finished packages shared between machines, stored as <key>/<file name>
+# The key says everything the package was built from, see Unit.getArtifactKey()
+# Both kinds of stores have get(key, name, pathDest), returning False if the store doesn't have it, and put(key, name, pathSrc)
+def openArtifactStore(spec):
+    # A directory, or an http(s) url taking GET and PUT
+    if spec.startswith('http://') or spec.startswith('https://'):
+        return HTTPArtifactStore(spec)
+    return DirArtifactStore(spec.removeprefix('file://'))
+
+class DirArtifactStore(object):
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def getPath(self, key, name):
+        return self.path / key[:2] / key / name
+
+    def get(self, key, name, pathDest):
+        pathObj = self.getPath(key, name)
+        if not pathObj.is_file():
+            return False
+        pathTmp = '{}.{:d}'.format(pathDest, os.getpid())
+        shutil.copyfile(pathObj, pathTmp)
+        os.replace(pathTmp, pathDest)
+        return True
+
+    def put(self, key, name, pathSrc):
+        pathObj = self.getPath(key, name)
+        pathObj.parent.mkdir(parents=True, exist_ok=True)
+        pathTmp = '{}.{:d}'.format(pathObj, os.getpid())
+        shutil.copyfile(pathSrc, pathTmp)
+        os.replace(pathTmp, pathObj)
+
+class HTTPArtifactStore(object):
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def getURL(self, key, name):
+        return '{}/{}/{}/{}'.format(self.url, key[:2], key, urllib.parse.quote(name))
+
+    def get(self, key, name, pathDest):
+        pathTmp = '{}.{:d}'.format(pathDest, os.getpid())
+        try:
+            with urllib.request.urlopen(self.getURL(key, name), timeout=60) as fp:
+                with open(pathTmp, 'wb') as fpw:
+                    shutil.copyfileobj(fp, fpw, SIZE_CHUNK)
+        except urllib.error.HTTPError as e:
+            Path(pathTmp).unlink(missing_ok=True)
+            if e.code == 404:
+                return False
+            raise
+        except BaseException:
+            Path(pathTmp).unlink(missing_ok=True)
+            raise
+        os.replace(pathTmp, pathDest)
+        return True
+
+    def put(self, key, name, pathSrc):
+        with open(pathSrc, 'rb') as fp:
+            req = urllib.request.Request(self.getURL(key, name), data=fp, method='PUT', headers={
+                'Content-Length': str(os.fstat(fp.fileno()).st_size),
+                'Content-Type': 'application/octet-stream',
+                })
+            with urllib.request.urlopen(req, timeout=600):
+                pass
@@ -13,13 +13,64 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+from hashlib import sha256
 from inspect import signature
 from pathlib import Path
 
 import Eikthyr as eik
+from luigi.task import flatten
 
-class TaskRunScript(eik.StampTask):
-    src = eik.TaskListParameter(significant=False)
+# Environment variables which change what a build phase produces, in addition to whatever the unit sets in environ
+aEnvPhase = ('CC', 'CXX', 'CPP', 'CFLAGS', 'CXXFLAGS', 'CPPFLAGS', 'LDFLAGS', 'PKG_CONFIG_PATH', 'CMAKE_PREFIX_PATH')
+
+# What a source was made from: the signatures down to the downloads, and the current content of local files
+def getSourceKey(task):
+    if isinstance(task, eik.InputTask):
+        return [repr(task), task.output().computeGenMeta()['out']]
+    return [task.getSignature(), task.getCodeHash(), [getSourceKey(t) for t in flatten(task.requires())]]
+
+# A phase is done when it was last run with the same key: its own code, the environment, the prefix, and the key of the phase before it
+# Unlike the output metadata, this doesn't change when the build writes into the source tree, or when only a later phase is edited
+# Only the first phase takes the sources in src, the later ones only follow prev
+# Otherwise checking a later phase would re-extract the sources under the earlier ones, wiping what they built
+class MixinPhase(object):
+    def getPathPhase(self):
+        return '{}.phase'.format(self.output().path)
+
+    def getPhaseKey(self):
+        if getattr(self, '_keyPhase', None) != None:
+            return self._keyPhase
+        aKey = [self.fun, self.getCodeHash(), str(self.unit.pathPrefix)]
+        for key in sorted(set(aEnvPhase) | set(self.unit.environ)):
+            aKey.append('{}={}'.format(key, os.environ.get(key, '')))
+        aPrev = [t for t in self.prev if isinstance(t, MixinPhase)]
+        if len(aPrev) > 0:
+            aKey += [t.getPhaseKey() for t in aPrev]
+        else: # The first phase depends on the sources, and whatever pre-processed them
+            aKey += [getSourceKey(t) for t in flatten(self.src)]
+            aKey += [[t.getSignature(), t.getCodeHash()] for t in self.prev]
+        self._keyPhase = sha256(json.dumps(aKey).encode('utf-8')).hexdigest()
+        return self._keyPhase
+
+    def savePhaseKey(self):
+        with open(self.getPathPhase(), 'w') as fpw:
+            fpw.write(self.getPhaseKey())
+
+    def complete(self):
+        if not Path(self.output().path).exists():
+            return False
+        if not all(Path(tgt.path).exists() for tgt in flatten(self.input()) if isinstance(tgt, eik.Target)):
+            return False
+        try:
+            with open(self.getPathPhase()) as fp:
+                return fp.read() == self.getPhaseKey()
+        except FileNotFoundError:
+            return False
+
+class TaskRunScript(MixinPhase, eik.StampTask):
+    src = eik.TaskListParameter((), significant=False)
     unit = eik.WhateverParameter(significant=False)
     fun = eik.Parameter()
 
@@ -42,9 +93,10 @@ class TaskRunScript(eik.StampTask):
             dirCD = dirCD / 'L0'
         with eik.chdir(dirCD):
             getattr(self.unit.__class__, self.fun)(self.unit)
+        self.savePhaseKey()
 
-class TaskRunPackageScript(eik.NITask):
-    src = eik.TaskParameter(significant=False)
+class TaskRunPackageScript(MixinPhase, eik.NITask):
+    src = eik.TaskListParameter((), significant=False)
     unit = eik.WhateverParameter(significant=False)
     fun = eik.Parameter()
     out = eik.PathParameter()
@@ -64,3 +116,4 @@ class TaskRunPackageScript(eik.NITask):
                     func(self.unit)
                 else:
                     func(self.unit, fw)
+        self.savePhaseKey()
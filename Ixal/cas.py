@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from hashlib import md5
+from pathlib import Path
+
+from .index import getFileDigest
+
+# Files stored by their sha256 under <path>/objects, plus an index remembering which url gave which digest
+# Safe to share between concurrent builds: objects are renamed into place, and the index is updated under a lock
+class ObjectStore(object):
+    def __init__(self, path):
+        self.path = Path(path)
+        self.pathObjects = self.path / 'objects'
+        self.pathIndex = self.path / 'urls.json'
+
+    def getPath(self, digest):
+        return self.pathObjects / digest[:2] / digest
+
+    def has(self, digest):
+        return self.getPath(digest).is_file()
+
+    @contextmanager
+    def lockIndex(self, mode=fcntl.LOCK_EX):
+        self.path.mkdir(parents=True, exist_ok=True)
+        with open('{}.lock'.format(self.pathIndex), 'a') as fpLock:
+            fcntl.flock(fpLock, mode)
+            try:
+                yield
+            finally:
+                fcntl.flock(fpLock, fcntl.LOCK_UN)
+
+    def readIndex(self):
+        try:
+            with self.pathIndex.open() as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def lookupURL(self, url):
+        with self.lockIndex(fcntl.LOCK_SH):
+            return self.readIndex().get(url)
+
+    def setURL(self, url, digest):
+        with self.lockIndex():
+            mIndex = self.readIndex()
+            if mIndex.get(url) == digest: return
+            mIndex[url] = digest
+            pathTmp = '{}.{:d}'.format(self.pathIndex, os.getpid())
+            with open(pathTmp, 'w') as fpw:
+                json.dump(mIndex, fpw, indent=1, sort_keys=True)
+            os.replace(pathTmp, self.pathIndex)
+
+    # A place to download something into before handing it to add(), on the same filesystem as the objects
+    # It stays the same for the same key, so an interrupted download can be resumed
+    # Only one process at a time gets the same key, the others wait
+    @contextmanager
+    def partialFile(self, key, name='file'):
+        pathPart = self.path / 'partial' / md5(key.encode('utf-8')).hexdigest()[:16]
+        pathPart.mkdir(parents=True, exist_ok=True)
+        with open('{}.lock'.format(pathPart), 'a') as fpLock:
+            fcntl.flock(fpLock, fcntl.LOCK_EX)
+            try:
+                yield pathPart / name
+            finally:
+                fcntl.flock(fpLock, fcntl.LOCK_UN)
+
+    # Move a file into the store, raise if it doesn't have the expected digest
+    # digestReal can be given if the content was already hashed while writing it
+    # Returns the digest
+    def add(self, pathFile, digest=None, digestReal=None):
+        if digestReal == None:
+            digestReal = getFileDigest(pathFile)
+        if digest and digestReal != digest.lower():
+            Path(pathFile).unlink() # Don't resume from this
+            raise RuntimeError("Checksum mismatch for {}: expected sha256 {}, got {}".format(pathFile, digest, digestReal))
+        pathObj = self.getPath(digestReal)
+        if pathObj.is_file(): # Same content from somewhere else, keep the old one so that the links stay shared
+            Path(pathFile).unlink()
+            return digestReal
+        pathObj.parent.mkdir(parents=True, exist_ok=True)
+        os.chmod(pathFile, 0o444) # Objects are shared through hardlinks, nobody should write into them
+        os.replace(pathFile, pathObj)
+        return digestReal
+
+    # Make the object appear at pathDest, without copying if possible
+    def link(self, digest, pathDest):
+        Path(pathDest).unlink(missing_ok=True)
+        try:
+            os.link(self.getPath(digest), pathDest)
+        except OSError:
+            shutil.copyfile(self.getPath(digest), pathDest)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import ast
+import importlib.util
+import json
+import os
+import sys
+from hashlib import sha256
+from inspect import isclass
+from pathlib import Path
+
+from .logging import logger
+
+# The class attributes we care about, and their defaults in Unit
+mAttrDefault = {
+        'name': '',
+        'ver': '1.0',
+        'rel': '1',
+        'epoch': 0,
+        'url': '',
+        'depends': (),
+        '_upstream': None,
+        '_rebuild': None,
+        }
+
+class NeedImport(Exception):
+    pass
+
+def isUnitBase(node):
+    if isinstance(node, ast.Name):
+        return node.id == 'Unit'
+    if isinstance(node, ast.Attribute):
+        return node.attr == 'Unit'
+    return False
+
+# Read the attributes of all Unit subclasses in the file without running it
+# Raise NeedImport when that isn't possible
+def scanRecipeAST(text):
+    mClass = {} # Unit subclasses defined in this file: name -> attributes
+    for node in ast.parse(text).body:
+        if not isinstance(node, ast.ClassDef): continue
+        mAttr = None
+        for base in node.bases:
+            if isUnitBase(base):
+                mAttr = dict(mAttrDefault)
+            elif isinstance(base, ast.Name) and base.id in mClass:
+                mAttr = dict(mClass[base.id])
+            elif isinstance(base, ast.Name) and base.id == 'object':
+                continue
+            else:
+                raise NeedImport(node.name)
+            break
+        if mAttr == None: continue
+        for stmt in node.body:
+            if isinstance(stmt, ast.Assign):
+                aTarget = stmt.targets
+            elif isinstance(stmt, (ast.AnnAssign, ast.AugAssign)) and stmt.value != None:
+                aTarget = [stmt.target]
+            else:
+                continue
+            aName = [n.id for t in aTarget for n in ast.walk(t) if isinstance(n, ast.Name) and n.id in mAttrDefault]
+            if len(aName) == 0: continue
+            # Only plain 'name = literal' and 'name: type = literal' can be read here
+            if isinstance(stmt, ast.AugAssign) or not all(isinstance(t, ast.Name) for t in aTarget):
+                raise NeedImport(node.name)
+            try:
+                val = ast.literal_eval(stmt.value)
+            except (ValueError, TypeError):
+                raise NeedImport(node.name)
+            for name in aName:
+                mAttr[name] = val
+        mClass[node.name] = mAttr
+    return [dict(mAttr, cls=name) for (name, mAttr) in mClass.items() if not name.startswith('_')]
+
+# Run a recipe file as a module
+def loadRecipe(path, name="module.dumb"):
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = mod
+    spec.loader.exec_module(mod)
+    return mod
+
+# The slow way: actually run the file
+def scanRecipeImport(path):
+    from .unit import Unit
+    mod = loadRecipe(path)
+    aInfo = []
+    for (name, cls) in mod.__dict__.items():
+        if name.startswith('_'): continue
+        if not isclass(cls) or not issubclass(cls, Unit) or cls is Unit: continue
+        mAttr = {key: getattr(cls, key, val) for (key, val) in mAttrDefault.items()}
+        aInfo.append(dict(mAttr, cls=name))
+    return aInfo
+
+def normalizeInfo(mInfo):
+    return json.loads(json.dumps(mInfo, default=str))
+
+# Class attributes of all the recipes under a directory, remembered across runs by file mtime and content hash
+# Only what was read without running the file is remembered: an imported recipe also depends on whatever it imports
+class RecipeCatalog(object):
+    def __init__(self, pathCache=None):
+        self.pathCache = pathCache
+        self.mFile = {}
+        if pathCache != None and Path(pathCache).exists():
+            try:
+                with Path(pathCache).open() as fp:
+                    self.mFile = json.load(fp)
+            except ValueError:
+                pass
+
+    def save(self):
+        if self.pathCache == None: return
+        Path(self.pathCache).parent.mkdir(parents=True, exist_ok=True)
+        pathTmp = '{}.{:d}'.format(self.pathCache, os.getpid())
+        mFile = {key: ent for (key, ent) in self.mFile.items() if not ent.get('imported')}
+        with open(pathTmp, 'w') as fpw:
+            json.dump(mFile, fpw, indent=1, sort_keys=True)
+        os.replace(pathTmp, self.pathCache)
+
+    # Returns a list of dicts having 'file', 'cls', and the attributes in mAttrDefault
+    def getFile(self, path):
+        path = Path(path).resolve()
+        key = str(path)
+        st = path.stat()
+        ent = self.mFile.get(key)
+        if ent != None and ent['mtime'] == st.st_mtime_ns and ent['size'] == st.st_size:
+            return ent['units']
+
+        data = path.read_bytes()
+        digest = sha256(data).hexdigest()
+        if ent == None or ent['sha256'] != digest:
+            isImported = False
+            try:
+                aInfo = scanRecipeAST(data)
+            except (NeedImport, SyntaxError) as e:
+                logger.debug("Need to import {} to know about {}".format(path, e))
+                try:
+                    aInfo = scanRecipeImport(path)
+                except BaseException as e:
+                    # Not remembered, it may well load next time
+                    logger.warning("Failed to load {}: {}".format(path, e))
+                    self.mFile.pop(key, None)
+                    return []
+                isImported = True
+            ent = {'units': [dict(normalizeInfo(mInfo), file=key) for mInfo in aInfo], 'sha256': digest}
+            if isImported:
+                ent['imported'] = True
+        ent.update(mtime=st.st_mtime_ns, size=st.st_size)
+        self.mFile[key] = ent
+        return ent['units']
+
+    def scan(self, directory):
+        if Path(directory).is_dir():
+            itr = sorted(Path(directory).glob('**/*.py'))
+        else:
+            itr = (Path(directory),)
+        aInfo = []
+        for f in itr:
+            aInfo += self.getFile(f)
+        self.save()
+        return aInfo
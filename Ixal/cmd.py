@@ -23,6 +23,7 @@ import Eikthyr as eik
 import plumbum.cmd as cmd
 from plumbum import local
 
+from .jobserver import getJobServerEnv, getNumJobs
 from .logging import logger
 
 class MixinBuildUtilities(object):
@@ -77,11 +78,16 @@ class MixinBuildUtilities(object):
             aParam.append('..')
         self.ex(eik.local['meson'][aParam])
 
-    def runNinja(self, *args, njobs=int(eik.getenv('IXAL_NUM_JOBS', '3'))):
+    # Without an explicit njobs, take jobs from the shared jobserver if the tool can, or IXAL_NUM_JOBS otherwise
+    def runNinja(self, *args, njobs=None):
         if sys.platform == 'cygwin' and os.getenv('MSYSTEM', '') != 'MSYS':
             with eik.withEnv(MSYSTEM='MSYS'):
-                return self.runNinja(*args)
-        self.ex(eik.cmd.ninja[('-j', '{:d}'.format(njobs), *args)])
+                return self.runNinja(*args, njobs=njobs)
+        mEnv = getJobServerEnv('ninja') if njobs == None else None
+        if mEnv != None:
+            with eik.withEnv(**mEnv):
+                return self.ex(eik.cmd.ninja[args])
+        self.ex(eik.cmd.ninja[('-j', '{:d}'.format(njobs or getNumJobs()), *args)])
 
     def runNinjaInstall(self, path, *args):
         if sys.platform == 'cygwin' and os.getenv('MSYSTEM', '') != 'MSYS':
@@ -90,8 +96,12 @@ class MixinBuildUtilities(object):
         with eik.withEnv(DESTDIR='{}/'.format(path)):
             self.ex(eik.cmd.ninja[(*args, 'install')])
 
-    def runMake(self, *args, njobs=int(eik.getenv('IXAL_NUM_JOBS', '3'))):
-        self.ex(eik.cmd.make[('-O', '-j{:d}'.format(njobs), *args)])
+    def runMake(self, *args, njobs=None):
+        mEnv = getJobServerEnv('make') if njobs == None else None
+        if mEnv != None:
+            with eik.withEnv(**mEnv):
+                return self.ex(eik.cmd.make[('-O', *args)])
+        self.ex(eik.cmd.make[('-O', '-j{:d}'.format(njobs or getNumJobs()), *args)])
 
     def runMakeInstall(self, path, *args):
         with eik.withEnv(DESTDIR='{}/'.format(path)):
@@ -14,6 +14,11 @@
 # limitations under the License.
 
 import re
+import threading
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from hashlib import md5, sha256
 from pathlib import Path
 from urllib.parse import urlparse
 
@@ -21,13 +26,17 @@ import Eikthyr as eik
 import luigi as lg
 from plumbum import local
 
+from .cas import ObjectStore
+from .stream import TeeReader
 
 class TaskDownload(eik.Task):
     url = eik.Parameter()
     pathCache = eik.PathParameter(significant=False)
     cmdcurl = eik.ListParameter(significant=False, default=('curl', '-qfLC', '-', '--ftp-pasv', '--retry', '5', '--retry-delay', '5', '-o', '{1}', '{0}'))
     filename = eik.Parameter('', significant=False)
+    sha256 = eik.Parameter('', positional=False) # Expected checksum, if known
 
+    isStreamable = True # Whether openStream() works
     def parseFileName(self): # This is purely heuristic...
         url = urlparse(self.url)
         if re.search(R'\.[^.]{2,5}$', url.query):
@@ -45,15 +54,93 @@ class TaskDownload(eik.Task):
             p = p.parent
         return p.name
 
+    # Each url gets its own directory, so that different urls with the same file name don't collide
     def generates(self):
         if self.filename == '':
-            return eik.Target(self, Path(self.pathCache) / self.parseFileName())
+            name = self.parseFileName()
         else:
-            return eik.Target(self, Path(self.pathCache) / self.filename)
+            name = self.filename
+        return eik.Target(self, Path(self.pathCache) / 'dl' / md5(self.url.encode('utf-8')).hexdigest()[:16] / name)
+
+    # Get the file from the object store if we know its content, otherwise download it into the store
+    def fetch(self, path):
+        store = ObjectStore(self.pathCache)
+        digest = self.getStoredDigest(store)
+        if digest:
+            self.logger.info("Cache hit for {}: {}".format(self.url, digest))
+        else:
+            with store.partialFile(self.url, Path(self.output().path).name) as pathPart:
+                # Someone else may have finished the same download while we were waiting
+                digest = self.getStoredDigest(store)
+                if not digest:
+                    self.download(pathPart)
+                    digest = store.add(pathPart, self.sha256)
+                    store.setURL(self.url, digest)
+        store.link(digest, path)
+
+    # The digest of the content, if it's already in the object store
+    def getStoredDigest(self, store):
+        digest = self.sha256.lower() or store.lookupURL(self.url)
+        if digest and store.has(digest):
+            return digest
+        return None
+
+    def openStream(self):
+        return urllib.request.urlopen(self.url, timeout=60)
+
+    # Download while handing the content to the caller as a stream
+    # The file is committed into the store, and to the output of this task, only after everything is read and verified
+    @contextmanager
+    def openFetch(self):
+        store = ObjectStore(self.pathCache)
+        with store.partialFile(self.url, Path(self.output().path).name) as pathPart:
+            h = sha256()
+            with self.openStream() as fpNet, open(pathPart, 'wb') as fpPart:
+                tee = TeeReader(fpNet, fpPart, h)
+                yield tee
+                tee.drain()
+            digest = store.add(pathPart, self.sha256, digestReal=h.hexdigest())
+            store.setURL(self.url, digest)
+        with self.output().pathWrite() as fw:
+            store.link(digest, fw)
+
+    def download(self, path):
+        self.ex(eik.cmdfmt(self.cmdcurl, self.url, path))
 
     def task(self):
         with self.output().pathWrite() as fw:
-            self.ex(eik.cmdfmt(self.cmdcurl, self.url, fw))
+            self.fetch(fw)
+
+# Run many download tasks outside of luigi, at most nPerHost at a time for each host
+# Their metadata are written just like luigi would do, so the builds afterwards see them as complete
+# Returns [(task, exception)] of the failed ones
+def fetchAll(aTask, nthreads=8, nPerHost=2):
+    mTask = {}
+    for t in aTask:
+        if t.output().path not in mTask and not t.complete():
+            mTask[t.output().path] = t
+    lock = threading.Lock()
+    mSemaphore = {}
+
+    def fetchOne(t):
+        host = urlparse(t.url).hostname or t.url
+        with lock:
+            if host not in mSemaphore:
+                mSemaphore[host] = threading.BoundedSemaphore(nPerHost)
+        with mSemaphore[host]:
+            with t.output().pathWrite() as fw:
+                t.fetch(fw)
+
+    aFailed = []
+    with ThreadPoolExecutor(nthreads) as executor:
+        mFuture = {executor.submit(fetchOne, t): t for t in mTask.values()}
+        for fut in as_completed(mFuture):
+            try:
+                fut.result()
+            except BaseException as e:
+                mFuture[fut].logger.error("Failed to fetch {}: {}".format(mFuture[fut].url, e))
+                aFailed.append((mFuture[fut], e))
+    return aFailed
 
 # Source: https://gist.github.com/sidneys/7095afe4da4ae58694d128b1034e01e2
 MAPYTEXT = {
@@ -86,6 +173,8 @@ MAPYTEXT = {
 class TaskDownloadYoutube(TaskDownload):
     cmdytd = eik.ListParameter(significant=False, default=('yt-dlp', '-f', '{2}', '-o', '{1}', '--', '{0}'))
 
+    isStreamable = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fmt, self.vidid = self.url.removeprefix('youtube://').split(':', 1)
@@ -93,6 +182,5 @@ class TaskDownloadYoutube(TaskDownload):
     def parseFileName(self): # This is purely heuristic...
         return '{}.{}'.format(self.vidid, MAPYTEXT[self.fmt])
 
-    def task(self):
-        with self.output().pathWrite() as fw:
-            self.ex(eik.cmdfmt(self.cmdytd, self.vidid, fw, self.fmt))
+    def download(self, path):
+        self.ex(eik.cmdfmt(self.cmdytd, self.vidid, path, self.fmt))
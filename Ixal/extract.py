@@ -13,21 +13,384 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import fnmatch
+import json
+import lzma
 import os
 import re
 import shutil
 import sys
+import tarfile
+import tempfile
+import zlib
+from abc import abstractmethod
+from functools import lru_cache
+from hashlib import sha256
 from pathlib import Path
 
 import Eikthyr as eik
 
+from .cas import ObjectStore
+from .index import getFileDigest
+from .stream import SIZE_CHUNK, openDecompressed
+
+RE_EXECUTABLE_WIN = re.compile(R'.*\.(dll|exe|cmd|bat|com|ps|ps1|js|vbs)$')
+
+# The mode an extracted file should end up with: always writable by us, and normalized on cygwin if asked to
+# umask is applied to the mode from the archive, like tar does for anyone but root
+def getFinalMode(name, mode, isDir, normalize=False, umask=0):
+    if normalize and sys.platform == "cygwin": # Special perm normalization
+        if isDir or RE_EXECUTABLE_WIN.match(name):
+            return 0o755
+        return 0o644
+    if isDir:
+        return (mode & 0o7777 & ~umask) | 0o700
+    return (mode & 0o7777 & ~umask) | 0o200
+
+# The umask to apply to modes from archives, 0 for root
+def getExtractUmask():
+    if os.geteuid() == 0:
+        return 0
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return umask
+
+# Errors meaning that python can't read the archive, as opposed to failing to write what it read
+# gzip and bz2 report bad data as OSError without an errno
+def isUnreadable(e):
+    if isinstance(e, (tarfile.TarError, EOFError, RuntimeError, zlib.error, lzma.LZMAError)):
+        return True
+    return isinstance(e, OSError) and e.errno == None
+
+# Fix permissions of everything under path in one walk, only touching the ones which need it
+def fixPerm(path, normalize=False):
+    aDir = [str(path)]
+    while len(aDir) > 0:
+        with os.scandir(aDir.pop()) as itr:
+            for ent in itr:
+                if ent.is_symlink(): continue
+                isDir = ent.is_dir(follow_symlinks=False)
+                mode = ent.stat(follow_symlinks=False).st_mode & 0o7777
+                modeFinal = getFinalMode(ent.name, mode, isDir, normalize)
+                if mode != modeFinal:
+                    os.chmod(ent.path, modeFinal)
+                if isDir:
+                    aDir.append(ent.path)
+
+# Member name relative to the archive root, None if it's something we shouldn't write
+def getSafeName(name):
+    aPart = [p for p in name.split('/') if p not in ('', '.')]
+    if len(aPart) == 0 or '..' in aPart:
+        return None
+    return '/'.join(aPart)
+
+# Raise if something on the way from dest down to path is a symlink, like bsdtar does by default
+# Otherwise an archive could put 'a -> /somewhere' first, and then write outside dest through 'a/file'
+def checkNoSymlink(dest, path):
+    rel = os.path.relpath(path, dest)
+    if rel == '.': return
+    pathThis = dest
+    for part in rel.split(os.sep):
+        pathThis = os.path.join(pathThis, part)
+        if os.path.islink(pathThis):
+            raise tarfile.ExtractError("Refusing to extract {} through the symlink {}".format(path, pathThis))
+
+# Selects members by their path in the archive, like recursive wildcards of 7z:
+# a pattern matches if it matches some part of the path between slashes, e.g. 'Doc' matches 'python/Doc/index.html'
+class PathFilter(object):
+    def __init__(self, include=(), exclude=()):
+        self.aInclude = tuple(include)
+        self.aExclude = tuple(exclude)
+        self.reInclude = self.compile(self.aInclude)
+        self.reExclude = self.compile(self.aExclude)
+
+    @staticmethod
+    def compile(aPattern):
+        if len(aPattern) == 0:
+            return None
+        # fnmatch.translate gives '(?s:...)\Z'
+        return re.compile('|'.join('(?:(?:.*/)?{}(?:/.*)?\\Z)'.format(fnmatch.translate(p.strip('/'))[:-2]) for p in aPattern))
+
+    def __bool__(self):
+        return self.reInclude != None or self.reExclude != None
+
+    def isExcluded(self, name):
+        return self.reExclude != None and self.reExclude.match(name) != None
+
+    def isIncluded(self, name):
+        return self.reInclude == None or self.reInclude.match(name) != None
+
+    def isSelected(self, name):
+        return self.isIncluded(name) and not self.isExcluded(name)
+
+    # Remove whatever not selected from an extracted tree
+    def prune(self, path):
+        def pruneDir(d, prefix):
+            isEmpty = True
+            with os.scandir(d) as itr:
+                aEnt = list(itr)
+            for ent in aEnt:
+                name = prefix + ent.name
+                isDir = ent.is_dir(follow_symlinks=False)
+                if self.isExcluded(name):
+                    if isDir: shutil.rmtree(ent.path)
+                    else: os.unlink(ent.path)
+                elif isDir:
+                    # Something inside may still be excluded, or included when this one isn't
+                    isInside = self.isIncluded(name)
+                    if isInside and self.reExclude == None: # Nothing inside will go
+                        isEmpty = False
+                    elif not pruneDir(ent.path, name + '/') or isInside:
+                        isEmpty = False
+                    else:
+                        os.rmdir(ent.path)
+                elif self.isIncluded(name):
+                    isEmpty = False
+                else:
+                    os.unlink(ent.path)
+            return isEmpty
+        if self:
+            pruneDir(str(path), '')
+
+    # The options for 7z to do the same thing
+    def get7zArgs(self):
+        return ['-ir!{}'.format(p) for p in self.aInclude] + ['-xr!{}'.format(p) for p in self.aExclude]
+
+# Extract a tar stream into pathDest in one pass, setting the final modes as members are written
+# If all the members are inside a single top-level directory, that directory is stripped along the way
+# Only the members selected by filt (a PathFilter) are written
+def extractTarStream(fpTar, pathDest, filt=None):
+    dest = str(pathDest)
+    top = None # The top-level directory we are stripping, '' if we gave up stripping
+    infoTop = None
+    sDir = {dest} # Directories known to exist
+    aDirTime = []
+    nFile = 0
+    umask = getExtractUmask()
+    with tarfile.open(fileobj=fpTar, mode='r|') as tar:
+        for info in tar:
+            name = getSafeName(info.name)
+            if name == None: continue
+            if filt and not filt.isSelected(name): continue
+            if top == None:
+                top = name.split('/')[0] if ('/' in name or info.isdir()) else ''
+            if len(top) > 0:
+                if name == top:
+                    infoTop = info
+                    continue
+                if not name.startswith(top + '/') or (info.islnk() and not (getSafeName(info.linkname) or '').startswith(top + '/')):
+                    # Not everything is inside the same directory after all: put back what we've done
+                    pathTmp = '{}.unstrip'.format(dest)
+                    os.rename(dest, pathTmp)
+                    os.mkdir(dest)
+                    os.rename(pathTmp, os.path.join(dest, top))
+                    sDir = {dest} | {os.path.join(dest, top, os.path.relpath(d, dest)) for d in sDir}
+                    aDirTime = [(os.path.join(dest, top, os.path.relpath(d, dest)), t) for (d, t) in aDirTime]
+                    if infoTop != None:
+                        os.chmod(os.path.join(dest, top), getFinalMode(top, infoTop.mode, True, umask=umask))
+                        aDirTime.insert(0, (os.path.join(dest, top), infoTop.mtime))
+                    top = ''
+                else:
+                    name = name[len(top)+1:]
+            path = os.path.join(dest, name)
+            dirParent = os.path.dirname(path)
+            if dirParent not in sDir:
+                checkNoSymlink(dest, dirParent)
+                os.makedirs(dirParent, exist_ok=True)
+                sDir.add(dirParent)
+
+            if info.isreg():
+                fd = openForWrite(path)
+                try:
+                    os.fchmod(fd, getFinalMode(name, info.mode, False, umask=umask))
+                    fpSrc = tar.extractfile(info)
+                    while True:
+                        data = fpSrc.read(SIZE_CHUNK)
+                        if not data: break
+                        os.write(fd, data)
+                    os.utime(fd, (info.mtime, info.mtime))
+                finally:
+                    os.close(fd)
+                nFile += 1
+            elif info.isdir():
+                if path not in sDir:
+                    checkNoSymlink(dest, path)
+                    os.makedirs(path, exist_ok=True)
+                    sDir.add(path)
+                os.chmod(path, getFinalMode(name, info.mode, True, umask=umask))
+                aDirTime.append((path, info.mtime))
+            elif info.issym():
+                removeExisting(path)
+                os.symlink(info.linkname, path)
+            elif info.islnk():
+                target = getSafeName(info.linkname)
+                if target == None: continue
+                if len(top) > 0:
+                    target = target[len(top)+1:]
+                if not os.path.lexists(os.path.join(dest, target)):
+                    # The data went with a member we didn't select, can't get it back from a stream
+                    raise tarfile.ExtractError("{} is a hardlink to the unselected {}".format(info.name, info.linkname))
+                checkNoSymlink(dest, os.path.dirname(os.path.join(dest, target)))
+                removeExisting(path)
+                os.link(os.path.join(dest, target), path, follow_symlinks=False)
+    # Directory times are only right after everything inside them is written
+    for (path, mtime) in reversed(aDirTime):
+        os.utime(path, (mtime, mtime))
+    return nFile
+
+# Create a new file, replacing whatever (but a directory) was there with the same name
+def openForWrite(path):
+    try:
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        os.unlink(path)
+        return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+
+def removeExisting(path):
+    if os.path.lexists(path):
+        os.unlink(path)
+
+# Whether files in dirSrc can be copied into dirDest by sharing their data blocks
+@lru_cache(maxsize=None)
+def canReflink(dirSrc, dirDest):
+    fd, pathSrc = tempfile.mkstemp(dir=dirSrc, prefix='tmp-reflink-')
+    os.close(fd)
+    pathDest = os.path.join(dirDest, os.path.basename(pathSrc))
+    try:
+        eik.cmd.cp('--reflink=always', pathSrc, pathDest)
+        return True
+    except Exception:
+        return False
+    finally:
+        os.unlink(pathSrc)
+        if os.path.lexists(pathDest):
+            os.unlink(pathDest)
+
+def getTreeSize(path):
+    size = 0
+    for (d, aDir, aFile) in os.walk(path):
+        for f in aFile:
+            size += os.lstat(os.path.join(d, f)).st_size
+    return size
+
+# Copy a directory tree, sharing the data blocks if the filesystem can do that
+# Hardlinks are not an option, as the build scripts happily modify files in place
+def cloneTree(src, dest):
+    try:
+        eik.cmd.cp('--reflink=auto', '-a', str(src), str(dest))
+    except Exception:
+        shutil.rmtree(dest, ignore_errors=True)
+        shutil.copytree(src, dest, symlinks=True)
+
 class TaskExtractBase(eik.Task):
     src = eik.TaskParameter()
     out = eik.PathParameter()
     password = eik.Parameter('', significant=False)
+    pathCache = eik.Parameter('', significant=False, positional=False) # Where pristine extracted trees are kept, '' to always extract
+    sizeTreeCache = eik.IntParameter(10 << 30, significant=False, positional=False) # Bytes of extracted trees to keep at most, least recently used go first
+    include = eik.ListParameter((), positional=False) # Only extract the paths matching these patterns (see PathFilter)
+    exclude = eik.ListParameter((), positional=False) # Don't extract the paths matching these patterns
 
     simplifiedOutputHash = True
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.filt = PathFilter(self.include, self.exclude)
+
+    # Whatever other than the archive content changing the extracted result
+    def getExtractParams(self):
+        return {'password': self.password, 'include': list(self.include), 'exclude': list(self.exclude)}
+
+    def getTreeKey(self):
+        key = '{}\n{}\n{}'.format(self.__class__.__name__, getFileDigest(self.input().path), json.dumps(self.getExtractParams(), sort_keys=True))
+        return sha256(key.encode('utf-8')).hexdigest()
+
+    # Extract the input into the directory target, which already exists
+    @abstractmethod
+    def extract(self, target):
+        pass
+
+    # The tree cache only pays off if its trees can be copied without copying the data
+    # Otherwise extracting into it and then copying out of it would double the I/O
+    def isTreeCacheUsable(self, fw):
+        if self.pathCache == '': return False
+        pathRoot = Path(self.pathCache) / 'trees'
+        pathRoot.mkdir(parents=True, exist_ok=True)
+        Path(fw).parent.mkdir(parents=True, exist_ok=True)
+        if not canReflink(str(pathRoot), str(Path(fw).parent)):
+            self.logger.debug("No reflink copies from {} to {}, extracting without the tree cache".format(pathRoot, Path(fw).parent))
+            return False
+        return True
+
+    # Each tree <key> has a <key>.size beside it, its mtime tells when the tree was last used
+    def getPathTreeSize(self, pathTree):
+        return Path('{}.size'.format(pathTree))
+
+    # Extract with func into a new directory of the tree cache, and keep it there under its key
+    def extractToTree(self, func):
+        pathRoot = Path(self.pathCache) / 'trees'
+        pathRoot.mkdir(parents=True, exist_ok=True)
+        pathTmp = tempfile.mkdtemp(dir=pathRoot, prefix='tmp-')
+        try:
+            os.chmod(pathTmp, 0o755)
+            func(pathTmp)
+            pathTree = pathRoot / self.getTreeKey()
+            size = getTreeSize(pathTmp)
+            try:
+                os.rename(pathTmp, pathTree)
+                self.getPathTreeSize(pathTree).write_text('{:d}\n'.format(size))
+            except OSError:
+                if not pathTree.is_dir(): raise # Otherwise someone else has just done the same extraction
+        finally:
+            shutil.rmtree(pathTmp, ignore_errors=True)
+        self.evictTrees(pathTree.name)
+        return pathTree
+
+    # Remove the least recently used trees until the others take at most sizeTreeCache bytes
+    def evictTrees(self, keyKeep):
+        pathRoot = Path(self.pathCache) / 'trees'
+        for pathTree in pathRoot.iterdir(): # Trees kept before sizes were recorded
+            if pathTree.is_dir() and not pathTree.name.startswith('tmp-') and not self.getPathTreeSize(pathTree).exists():
+                self.getPathTreeSize(pathTree).write_text('{:d}\n'.format(getTreeSize(pathTree)))
+        aTree = []
+        for pathSize in pathRoot.glob('*.size'):
+            try:
+                aTree.append((pathSize.stat().st_mtime, int(pathSize.read_text()), pathSize.stem))
+            except (FileNotFoundError, ValueError):
+                continue
+        total = sum(size for (_, size, _) in aTree)
+        for (_, size, key) in sorted(aTree):
+            if total <= self.sizeTreeCache: break
+            if key == keyKeep: continue
+            # Out of sight first, so that nobody starts copying it while it's being removed
+            pathGone = pathRoot / 'tmp-evict-{}'.format(key)
+            try:
+                os.rename(pathRoot / key, pathGone)
+            except OSError:
+                continue # Someone else got it
+            self.getPathTreeSize(pathRoot / key).unlink(missing_ok=True)
+            shutil.rmtree(pathGone, ignore_errors=True)
+            total -= size
+            self.logger.debug("Evicted extracted tree {} ({:d} bytes)".format(key, size))
+
+    def task(self):
+        with self.output().pathWrite() as fw:
+            if not self.isTreeCacheUsable(fw):
+                Path(fw).mkdir(parents=True, exist_ok=True)
+                self.extract(fw)
+                return
+
+            pathTree = Path(self.pathCache) / 'trees' / self.getTreeKey()
+            if pathTree.is_dir():
+                self.logger.info("Reusing extracted tree {} for {}".format(pathTree.name, self.input().path))
+                try:
+                    os.utime(self.getPathTreeSize(pathTree))
+                except FileNotFoundError:
+                    pass
+            else:
+                pathTree = self.extractToTree(self.extract)
+            cloneTree(pathTree, fw)
+
     def killRedundantDir(self, path):
         while True:
             aContent = list(Path(path).iterdir())
@@ -38,37 +401,86 @@ class TaskExtractBase(eik.Task):
             if len(list(aContent[0].iterdir())) == 0:
                 aContent[0].rmdir()
 
-    def normalizePerm(self, path):
-        if sys.platform == "cygwin": # Special perm normalization
-            for f in Path(path).glob('**/*'):
-                if f.is_dir():
-                    f.chmod(0o755)
-                    continue
-                if re.match('.*\.(dll|exe|cmd|bat|com|ps|ps1|js|vbs)$', f.name):
-                    f.chmod(0o755)
-                else:
-                    f.chmod(0o644)
-
     def makeWritable(self, path):
-        # Make all extracted files writable
-        for f in Path(path).glob('**/*'):
-            mode = f.stat().st_mode
-            if not mode & 0o200:
-                f.chmod(mode | 0o200)
+        fixPerm(path)
+
+    # Also make all extracted files writable
+    def normalizePerm(self, path):
+        fixPerm(path, normalize=True)
 
 
 class TaskExtractTar(TaskExtractBase):
     cmdTar = eik.ListParameter(significant=False, default=('bsdtar', 'xf', '{0}', '-C', '{1}'))
+    inProcess = eik.BoolParameter(True, significant=False, positional=False) # False: always use cmdTar
 
-    def task(self):
+    def extractInProcess(self, target):
+        with open(self.input().path, 'rb') as fp:
+            with openDecompressed(fp, self.input().path) as fpTar:
+                nFile = extractTarStream(fpTar, target, self.filt)
+        self.logger.debug("Extracted {:d} files from {}".format(nFile, self.input().path))
+
+    def extract(self, target):
         cmdReal = list(self.cmdTar)
         if self.cmdTar[0] == 'bsdtar' and not 'bsdtar' in eik.local: # Default fallback
             cmdReal[0] = 'tar'
+        try:
+            if not self.inProcess:
+                raise tarfile.ReadError("In-process extraction disabled")
+            self.extractInProcess(target)
+        except Exception as e:
+            if not isUnreadable(e): raise
+            # Something python can't deal with, like an unusual compression: let the real tar do it
+            self.logger.debug("Falling back to {}: {}".format(cmdReal[0], e))
+            shutil.rmtree(target)
+            Path(target).mkdir(parents=True, exist_ok=True)
+            self.ex(eik.cmdfmt(cmdReal, self.input().path, target))
+            self.makeWritable(target)
+            self.filt.prune(target)
+        self.killRedundantDir(target)
+
+# Extract a tar archive while it's being downloaded
+# The download task is not run beforehand: its output only appears after the whole archive is verified
+class TaskStreamExtractTar(TaskExtractTar):
+    def requires(self):
+        return []
+
+    def input(self):
+        return self.src.output()
+
+    def isStreaming(self):
+        if not getattr(self.src, 'isStreamable', False) or self.src.complete():
+            return False
+        return not self.src.getStoredDigest(ObjectStore(self.src.pathCache))
+
+    def extractStreaming(self, target):
+        try:
+            with self.src.openFetch() as fp:
+                try:
+                    with openDecompressed(fp, self.input().path) as fpTar:
+                        nFile = extractTarStream(fpTar, target, self.filt)
+                    self.logger.debug("Extracted {:d} files while downloading {}".format(nFile, self.src.url))
+                    return
+                except (tarfile.TarError, RuntimeError, EOFError) as e:
+                    self.logger.debug("Can't extract while downloading, will do it afterwards: {}".format(e))
+        finally:
+            self.src.invalidateCache()
+        shutil.rmtree(target)
+        Path(target).mkdir(parents=True, exist_ok=True)
+        self.extract(target)
+
+    def task(self):
+        if not self.isStreaming():
+            if not self.src.complete():
+                self.src.task()
+                self.src.invalidateCache()
+            return super().task()
+
         with self.output().pathWrite() as fw:
-            Path(fw).mkdir(parents=True, exist_ok=True)
-            self.ex(eik.cmdfmt(cmdReal, self.input().path, fw))
-            self.makeWritable(fw)
-            self.killRedundantDir(fw)
+            if not self.isTreeCacheUsable(fw):
+                Path(fw).mkdir(parents=True, exist_ok=True)
+                self.extractStreaming(fw)
+            else:
+                cloneTree(self.extractToTree(self.extractStreaming), fw)
 
 class TaskExtractMSI(TaskExtractBase):
     cmdMSI = eik.ListParameter(significant=False, default=('msiexec', '/a', '{0}', '/qb', 'TARGETDIR={1}'))
@@ -81,13 +493,11 @@ class TaskExtractMSI(TaskExtractBase):
         except:
             shutil.copy(self.input().path, target)
 
-    def task(self):
-        with self.output().pathWrite() as fw:
-            Path(fw).mkdir(parents=True, exist_ok=True)
-            self.doExtract(self.cmdMSI, fw)
-            self.makeWritable(fw)
-            self.normalizePerm(fw)
-            self.killRedundantDir(fw)
+    def extract(self, target):
+        self.doExtract(self.cmdMSI, target)
+        self.normalizePerm(target)
+        self.filt.prune(target)
+        self.killRedundantDir(target)
 
 class TaskExtract7z(TaskExtractBase):
     cmd7z = eik.ListParameter(significant=False, default=('7zz', '-y', 'x', '-o{1}', '{0}'))
@@ -95,7 +505,7 @@ class TaskExtract7z(TaskExtractBase):
     def doExtract(self, cmd, target):
         self.ex(eik.cmdfmt(cmd, self.input().path, target))
 
-    def task(self):
+    def extract(self, target):
         cmdReal = list(self.cmd7z)
         if self.cmd7z[0] == '7zz' and not '7zz' in eik.local: # Default fallback
             if '7z' in eik.local:
@@ -104,12 +514,11 @@ class TaskExtract7z(TaskExtractBase):
                 cmdReal[0] = '7za'
         if self.password != '':
             cmdReal.insert(1, '-p{}'.format(self.password))
-        with self.output().pathWrite() as fw:
-            Path(fw).mkdir(parents=True, exist_ok=True)
-            self.doExtract(cmdReal, fw)
-            self.makeWritable(fw)
-            self.normalizePerm(fw)
-            self.killRedundantDir(fw)
+        cmdReal += self.filt.get7zArgs()
+        self.doExtract(cmdReal, target)
+        self.normalizePerm(target)
+        self.filt.prune(target)
+        self.killRedundantDir(target)
 
 class TaskExtract7zOptional(TaskExtract7z):
     def doExtract(self, cmd, target):
@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import sqlite3
+import tarfile
+import time
+from hashlib import sha256
+from pathlib import Path
+
+from .stream import SIZE_CHUNK, openDecompressed
+
+VERSION_SCHEMA = 1 # Older indexes are thrown away and re-imported
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    val TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pkg (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    dirname TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    desc TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    srchash TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (name, version)
+);
+CREATE TABLE IF NOT EXISTS file (
+    dirname TEXT NOT NULL,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_dirname ON file (dirname);
+'''
+
+# Parse the text of a desc file into {key: [values...]}
+def parseDesc(text):
+    mInfo = {}
+    for block in text.split('\n\n'):
+        aLine = block.strip('\n').split('\n')
+        if len(aLine[0]) < 3 or not aLine[0].startswith('%'): continue
+        mInfo[aLine[0].strip('%')] = aLine[1:]
+    return mInfo
+
+# The paths in the text of a files file
+def parseFiles(text):
+    return [line for line in text.split('\n') if len(line) > 0 and line != '%FILES%']
+
+def getFileDigest(path):
+    h = sha256()
+    with Path(path).open('rb') as fp:
+        while True:
+            data = fp.read(SIZE_CHUNK)
+            if not data: break
+            h.update(data)
+    return h.hexdigest()
+
+# A persistent, incrementally updated copy of the repo database, keyed by package name and version
+class RepoIndex(object):
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(str(self.path))
+        if self.db.execute('PRAGMA user_version').fetchone()[0] != VERSION_SCHEMA:
+            self.db.executescript('DROP TABLE IF EXISTS meta; DROP TABLE IF EXISTS pkg; DROP TABLE IF EXISTS file;')
+            self.db.execute('PRAGMA user_version={:d}'.format(VERSION_SCHEMA))
+        self.db.executescript(SCHEMA)
+        self.changed = False
+
+    def __enter__(self):
+        return self
+
+    # Half-written packages are not kept
+    def __exit__(self, typ, *args):
+        if typ != None:
+            self.db.rollback()
+            self.changed = False
+        self.close()
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    # Every commit containing changes to the packages bumps the generation number
+    def commit(self):
+        if self.changed:
+            self.setMeta('generation', self.getGeneration() + 1)
+            self.changed = False
+        self.db.commit()
+
+    def getGeneration(self):
+        return int(self.getMeta('generation', '0'))
+
+    def getMeta(self, key, default=''):
+        row = self.db.execute('SELECT val FROM meta WHERE key=?', (key,)).fetchone()
+        if row == None:
+            return default
+        return row[0]
+
+    def setMeta(self, key, val):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, val) VALUES (?, ?)', (key, str(val)))
+
+    # Remember that a "files" archive with this digest is exactly the current content of the index
+    def setArchive(self, digest):
+        self.commit()
+        self.db.execute("DELETE FROM meta WHERE key LIKE 'archive:%'")
+        self.setMeta('archive:{}'.format(digest), self.getGeneration())
+
+    def isArchiveCurrent(self, digest):
+        return self.getMeta('archive:{}'.format(digest)) == str(self.getGeneration())
+
+    # The file list of a package is put separately, see putFiles() and addFile()
+    def put(self, dirname, desc, mtime=None, srchash=''):
+        mInfo = parseDesc(desc)
+        if mtime == None:
+            mtime = int(time.time())
+        self.db.execute('INSERT OR REPLACE INTO pkg (name, version, dirname, filename, desc, mtime, srchash) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (mInfo['NAME'][0], mInfo['VERSION'][0], dirname, mInfo['FILENAME'][0], desc, mtime, srchash))
+        self.changed = True
+
+    # Replace the file list of a package, aPath can be any iterable
+    def putFiles(self, dirname, aPath=()):
+        self.db.execute('DELETE FROM file WHERE dirname=?', (dirname,))
+        self.db.executemany('INSERT INTO file (dirname, path) VALUES (?, ?)', ((dirname, path) for path in aPath))
+        self.changed = True
+
+    # Append one path to the file list of a package, for lists too long to be held in memory
+    def addFile(self, dirname, path):
+        self.db.execute('INSERT INTO file (dirname, path) VALUES (?, ?)', (dirname, path))
+
+    def remove(self, name, version):
+        self.db.execute('DELETE FROM file WHERE dirname IN (SELECT dirname FROM pkg WHERE name=? AND version=?)', (name, version))
+        self.db.execute('DELETE FROM pkg WHERE name=? AND version=?', (name, version))
+        self.changed = True
+
+    def hasPackage(self, filename, srchash):
+        row = self.db.execute('SELECT 1 FROM pkg WHERE filename=? AND srchash=?', (filename, srchash)).fetchone()
+        return row != None
+
+    # Yields (name, version, filename, dirname) of everything in the index
+    def iterVersions(self):
+        yield from self.db.execute('SELECT name, version, filename, dirname FROM pkg')
+
+    # Yields (dirname, desc, files, mtime), with the text of the files file put back together
+    def iterEntries(self):
+        for (dirname, desc, mtime) in self.db.execute('SELECT dirname, desc, mtime FROM pkg ORDER BY dirname'):
+            aPath = (row[0] for row in self.db.execute('SELECT path FROM file WHERE dirname=? ORDER BY rowid', (dirname,)))
+            yield (dirname, desc, '%FILES%\n{}'.format(''.join('{}\n'.format(path) for path in aPath)), mtime)
+
+    # Throw away everything and load the content of a .files (or .db) archive
+    def importArchive(self, pathArchive):
+        self.db.execute('DELETE FROM pkg')
+        self.db.execute('DELETE FROM file')
+        self.changed = True
+        mPending = {} # dirname -> {'desc': ..., 'files': ..., 'mtime': ...}
+        with Path(pathArchive).open('rb') as fp:
+            with openDecompressed(fp, pathArchive) as fpTar:
+                with tarfile.open(fileobj=fpTar, mode='r|') as tar:
+                    for info in tar:
+                        if not info.isfile(): continue
+                        dirname, _, key = info.name.removeprefix('./').rpartition('/')
+                        if key not in ('desc', 'files'): continue
+                        ent = mPending.setdefault(dirname, {'files': '', 'mtime': int(info.mtime)})
+                        ent[key] = tar.extractfile(info).read().decode('utf-8')
+                        if 'desc' in ent and len(ent['files']) > 0:
+                            self.put(dirname, ent['desc'], ent['mtime'])
+                            self.putFiles(dirname, parseFiles(ent['files']))
+                            del mPending[dirname]
+        for (dirname, ent) in mPending.items():
+            if 'desc' in ent:
+                self.put(dirname, ent['desc'], ent['mtime'])
+                self.putFiles(dirname, parseFiles(ent['files']))
+        self.commit()
+
+    # Total uncompressed size of the database content
+    def getSize(self):
+        sizeDesc = self.db.execute('SELECT COALESCE(SUM(LENGTH(desc)), 0) FROM pkg').fetchone()[0]
+        sizeFiles = self.db.execute('SELECT COALESCE(SUM(LENGTH(path) + 1), 0) FROM file').fetchone()[0]
+        return sizeDesc + sizeFiles
+
+# Write the repo database as uncompressed tar streams, with and without the file lists, in one go
+# aEntries is an iterable of (dirname, desc, files, mtime)
+def writeRepoArchives(aEntries, fpDB, fpFiles):
+    with tarfile.open(fileobj=fpDB, mode='w|', format=tarfile.PAX_FORMAT) as tarDB:
+        with tarfile.open(fileobj=fpFiles, mode='w|', format=tarfile.PAX_FORMAT) as tarFiles:
+            for (dirname, desc, files, mtime) in aEntries:
+                info = tarfile.TarInfo(dirname)
+                info.type = tarfile.DIRTYPE
+                info.mode = 0o755
+                info.mtime = mtime
+                tarDB.addfile(info)
+                tarFiles.addfile(info)
+                addTarData(tarDB, '{}/desc'.format(dirname), desc, mtime)
+                addTarData(tarFiles, '{}/desc'.format(dirname), desc, mtime)
+                addTarData(tarFiles, '{}/files'.format(dirname), files, mtime)
+
+def addTarData(tar, name, text, mtime):
+    data = text.encode('utf-8')
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    info.mtime = mtime
+    tar.addfile(info, io.BytesIO(data))
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from functools import lru_cache
+
+import Eikthyr as eik
+
+# A GNU make style jobserver: a named pipe holding one byte for each job allowed to run, on top of the one every client has for free
+# Every make or ninja started with getJobServerEnv() takes its jobs from the same pool, no matter which unit it builds
+class JobServer(object):
+    def __init__(self, nTokens):
+        self.nTokens = nTokens
+        self.pathDir = tempfile.mkdtemp(prefix='ixal-jobserver-')
+        self.path = os.path.join(self.pathDir, 'fifo')
+        os.mkfifo(self.path, 0o600)
+        # Keep it open for both reading and writing, so that it never sees an EOF while clients come and go
+        self.fd = os.open(self.path, os.O_RDWR)
+        os.write(self.fd, b'+' * nTokens)
+
+    def close(self):
+        os.close(self.fd)
+        shutil.rmtree(self.pathDir, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# (major, minor) of a build tool, (0, 0) if it can't be found
+@lru_cache(maxsize=None)
+def getToolVersion(name):
+    try:
+        out = subprocess.run((name, '--version'), capture_output=True, text=True).stdout
+    except OSError:
+        return (0, 0)
+    m = re.search(R'([0-9]+)\.([0-9]+)', out)
+    if not m:
+        return (0, 0)
+    return (int(m[1]), int(m[2]))
+
+# Named pipe jobservers are understood since make 4.4 and ninja 1.13
+mMinVersion = {'make': (4, 4), 'ninja': (1, 13)}
+
+# Environment for running tool as a client of the jobserver in IXAL_JOBSERVER, or None when that's not possible
+def getJobServerEnv(tool):
+    path = eik.getenv('IXAL_JOBSERVER', '')
+    if not path or not os.path.exists(path):
+        return None
+    if getToolVersion(tool) < mMinVersion[tool]:
+        return None
+    flags = '-j{:d} --jobserver-auth=fifo:{}'.format(getNumJobs(), path)
+    if eik.getenv('MAKEFLAGS', ''):
+        flags = '{} {}'.format(flags, eik.getenv('MAKEFLAGS'))
+    return {'MAKEFLAGS': flags}
+
+# Number of parallel jobs for a single build, read every time as the scheduler may change it
+def getNumJobs():
+    return int(eik.getenv('IXAL_NUM_JOBS', '3'))
@@ -13,31 +13,137 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
 import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import urlparse
 
 import requests
 from lastversion import has_update
 
 from .ver import vercmp
 
-def isLatest(spec, ver):
-    src, repo = spec.split(':', 1)
-    if src == 'arch':
-        res = requests.get('https://archlinux.org/packages/{}'.format(repo))
-        html = res.content.decode('utf-8')
-        latest = re.search(R'<h2>[^< ]+ ([^<-]+)-[^<]*</h2>', html)[1]
-    elif src == 'alpine':
-        res = requests.get('https://pkgs.alpinelinux.org/package/edge/{}'.format(repo))
-        html = res.content.decode('utf-8')
-        latest = re.search(R'Flag this package out of date[^>]+>([^<-]+)-[^<]*</a>', html)[1]
-    elif src == 'portapps':
-        res = requests.get('https://portableapps.com/apps/{}'.format(repo))
-        html = res.content.decode('utf-8')
-        latest = re.search(R'<p class=[^>]+>Version ([^ ]+) ', html)[1]
-    else:
-        return has_update(repo=repo, at=src, current_version=ver)
-
-    if vercmp(ver, latest) == -1:
-        return latest
-    else:
+# Upstreams we scrape by ourselves: (url template, regex giving the version in group 1)
+mUpstream = {
+        'arch': ('https://archlinux.org/packages/{}', R'<h2>[^< ]+ ([^<-]+)-[^<]*</h2>'),
+        'alpine': ('https://pkgs.alpinelinux.org/package/edge/{}', R'Flag this package out of date[^>]+>([^<-]+)-[^<]*</a>'),
+        'portapps': ('https://portableapps.com/apps/{}', R'<p class=[^>]+>Version ([^ ]+) '),
+        }
+
+class LatestChecker(object):
+    # mUpstream: in the same form as the module-level one, to scrape some other servers instead
+    def __init__(self, pathCache=None, ttl=6*3600, nthreads=16, nPerHost=4, mUpstream=mUpstream):
+        self.pathCache = pathCache
+        self.mUpstream = mUpstream
+        self.ttl = ttl
+        self.nthreads = nthreads
+        self.nPerHost = nPerHost
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.mSemaphore = {}
+        self.mCache = {}
+        if pathCache != None and Path(pathCache).exists():
+            try:
+                with Path(pathCache).open() as fp:
+                    self.mCache = json.load(fp)
+            except ValueError:
+                pass
+
+    def save(self):
+        if self.pathCache == None: return
+        Path(self.pathCache).parent.mkdir(parents=True, exist_ok=True)
+        pathTmp = '{}.{:d}'.format(self.pathCache, os.getpid())
+        with self.lock:
+            with open(pathTmp, 'w') as fpw:
+                json.dump(self.mCache, fpw, indent=1, sort_keys=True)
+        os.replace(pathTmp, self.pathCache)
+
+    def getSession(self):
+        if not hasattr(self.local, 'session'):
+            self.local.session = requests.Session()
+        return self.local.session
+
+    def getSemaphore(self, host):
+        with self.lock:
+            if host not in self.mSemaphore:
+                self.mSemaphore[host] = threading.BoundedSemaphore(self.nPerHost)
+            return self.mSemaphore[host]
+
+    def getCached(self, key):
+        with self.lock:
+            ent = self.mCache.get(key)
+        if ent != None and time.time() - ent['time'] < self.ttl:
+            return ent
         return None
+
+    def putCached(self, key, **kwargs):
+        with self.lock:
+            self.mCache[key] = dict(kwargs, time=time.time())
+
+    # Scrape the latest version from an url, asking the server whether it has changed since last time
+    def fetchLatest(self, url, pattern):
+        ent = self.getCached(url)
+        if ent != None:
+            return ent['latest']
+        with self.lock:
+            entOld = self.mCache.get(url, {})
+        headers = {}
+        if 'etag' in entOld:
+            headers['If-None-Match'] = entOld['etag']
+        if 'lastmod' in entOld:
+            headers['If-Modified-Since'] = entOld['lastmod']
+        with self.getSemaphore(urlparse(url).netloc):
+            res = self.getSession().get(url, headers=headers, timeout=60)
+        if res.status_code == 304 and 'latest' in entOld:
+            latest = entOld['latest']
+        else:
+            res.raise_for_status()
+            latest = re.search(pattern, res.content.decode('utf-8'))[1]
+        mEntry = {'latest': latest}
+        if 'ETag' in res.headers:
+            mEntry['etag'] = res.headers['ETag']
+        if 'Last-Modified' in res.headers:
+            mEntry['lastmod'] = res.headers['Last-Modified']
+        self.putCached(url, **mEntry)
+        return latest
+
+    # Returns the newer version if there's one, None otherwise
+    def check(self, spec, ver):
+        src, repo = spec.split(':', 1)
+        if src in self.mUpstream:
+            url, pattern = self.mUpstream[src]
+            latest = self.fetchLatest(url.format(repo), pattern)
+            if vercmp(ver, latest) == -1:
+                return latest
+            return None
+
+        key = '{} {}'.format(spec, ver)
+        ent = self.getCached(key)
+        if ent != None:
+            return ent['latest']
+        with self.getSemaphore(src):
+            latest = has_update(repo=repo, at=src, current_version=ver)
+        if latest:
+            latest = str(latest)
+        else:
+            latest = None
+        self.putCached(key, latest=latest)
+        return latest
+
+    # Check many (spec, ver, whatever) at once, yielding (whatever, result, exception) as they complete
+    def checkAll(self, aJob):
+        with ThreadPoolExecutor(self.nthreads) as executor:
+            mFuture = {executor.submit(self.check, spec, ver): obj for (spec, ver, obj) in aJob}
+            for fut in as_completed(mFuture):
+                try:
+                    yield (mFuture[fut], fut.result(), None)
+                except BaseException as e:
+                    yield (mFuture[fut], None, e)
+        self.save()
+
+def isLatest(spec, ver):
+    return LatestChecker(ttl=0).check(spec, ver)
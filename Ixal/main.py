@@ -13,109 +13,181 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import importlib.util
 import sys
-from inspect import isclass
 from pathlib import Path
 
-import Eikthyr as eik
-import Ixal
-from colorama import Fore, Style
+# Heavy imports are done inside each subcommand, so that each one only pays for what it uses
 
-from .latest import isLatest
-from .ver import vercmp
-
-def doAdd(fnameOutput, fnameInput, *aPkg, aDel=[]):
+def doAdd(fnameOutput, fnameInput, *aPkg, aDel=[], lvl=22, budget=0):
+    import Eikthyr as eik
+    from .repo import TaskRepoAdd
     fnameDB = '{}.db'.format(fnameOutput.removesuffix('.files'))
     aTPkg = [eik.InputTask(f) for f in aPkg]
-    eik.run(Ixal.TaskRepoAdd(fnameDB, fnameOutput, eik.InputTask(fnameInput), aTPkg, aDel=aDel))
+    eik.run(TaskRepoAdd(fnameDB, fnameOutput, eik.InputTask(fnameInput), aTPkg, aDel=aDel, lvl=lvl, budget=budget))
 
-def doLatest(directory):
-    if Path(directory).is_dir():
-        itr = Path(directory).glob('**/*.py')
-    else:
-        itr = (Path(directory),)
-    for f in itr:
-        spec = importlib.util.spec_from_file_location("module.dumb", f)
-        mod = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(mod)
-        for cls in (c for name,c in mod.__dict__.items() if not name.startswith('_')):
-            if not isclass(cls) or not issubclass(cls, Ixal.Unit):
-                continue
-            if '_upstream' not in dir(cls) or 'name' not in dir(cls) or 'ver' not in dir(cls):
-                continue
-            print('Checking {} from {} ...'.format(cls.name, cls._upstream), end=' ')
+def getCatalog():
+    from .catalog import RecipeCatalog
+    from .unit import UnitConfig
+    return RecipeCatalog(Path(UnitConfig().pathCache) / 'catalog.json')
+
+def doLatest(directory, ttl=6*3600, nthreads=16):
+    from colorama import Fore, Style
+    from .latest import LatestChecker
+    from .unit import UnitConfig
+    aJob = []
+    for info in getCatalog().scan(directory):
+        if info['_upstream'] == None:
+            continue
+        if info['_upstream'].startswith('manual'):
             try:
-                if cls._upstream.startswith('manual'):
-                    try:
-                        url = cls._upstream.split(':',1)[1]
-                    except:
-                        url = cls.url
-                    print('{}{}MANUAL {} {}{}'.format(Fore.CYAN, Style.BRIGHT, cls.ver, url, Style.RESET_ALL))
-                else:
-                    lv = isLatest(cls._upstream, cls.ver)
-                    if lv:
-                        print('{}{}Outdated: {}{}'.format(Fore.YELLOW, Style.BRIGHT, lv, Style.RESET_ALL))
-                    else:
-                        print('{}{}OK{}'.format(Fore.GREEN, Style.BRIGHT, Style.RESET_ALL))
-            except BaseException as e:
-                print('{}{}ERROR {}{}'.format(Fore.RED, Style.BRIGHT, e, Style.RESET_ALL))
+                url = info['_upstream'].split(':',1)[1]
+            except:
+                url = info['url']
+            print('{} from {} ... {}{}MANUAL {} {}{}'.format(info['name'], info['_upstream'], Fore.CYAN, Style.BRIGHT, info['ver'], url, Style.RESET_ALL))
+        else:
+            aJob.append((info['_upstream'], info['ver'], info))
+
+    checker = LatestChecker(Path(UnitConfig().pathCache) / 'latest.json', ttl=ttl, nthreads=nthreads)
+    for (info, lv, e) in checker.checkAll(aJob):
+        print('{} from {} ...'.format(info['name'], info['_upstream']), end=' ')
+        if e != None:
+            print('{}{}ERROR {}{}'.format(Fore.RED, Style.BRIGHT, e, Style.RESET_ALL))
+        elif lv:
+            print('{}{}Outdated: {}{}'.format(Fore.YELLOW, Style.BRIGHT, lv, Style.RESET_ALL))
+        else:
+            print('{}{}OK{}'.format(Fore.GREEN, Style.BRIGHT, Style.RESET_ALL))
 
 def doRebuild():
+    from colorama import Fore, Style
+    from .ver import getVersionKey
     mVer = {}
     mRebuild = {}
-    for f in Path('.').glob('**/*.py'):
-        try:
-            spec = importlib.util.spec_from_file_location("module.dumb", f)
-            mod = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(mod)
-        except:
+    for info in getCatalog().scan('.'):
+        if len(info['name']) == 0:
             continue
-        for cls in (c for name,c in mod.__dict__.items() if not name.startswith('_')):
-            if not isclass(cls) or not issubclass(cls, Ixal.Unit) or cls is Ixal.Unit:
-                continue
-            if 'name' not in dir(cls) or 'ver' not in dir(cls) or len(cls.name) == 0:
-                continue
-            mVer[cls.name] = '{}-{}'.format(cls.ver, cls.rel)
-            if '_rebuild' in dir(cls):
-                if isinstance(cls._rebuild, str):
-                    cls._rebuild = (cls._rebuild,)
-                for strDep in cls._rebuild:
-                    pkg, ver = strDep.split(' ', 2)
-                    if cls.name not in mRebuild:
-                        mRebuild[cls.name] = {}
-                    mRebuild[cls.name][pkg] = ver
-            #print('Checking {} from {} ...'.format(cls.name, mVer[cls.name]))
+        aNames = info['name']
+        if isinstance(aNames, str):
+            aNames = (aNames,)
+        for name in aNames:
+            mVer[name] = '{}-{}'.format(info['ver'], info['rel'])
+        if info['_rebuild'] != None:
+            aRebuild = info['_rebuild']
+            if isinstance(aRebuild, str):
+                aRebuild = (aRebuild,)
+            for strDep in aRebuild:
+                pkg, ver = strDep.split(' ', 2)
+                if aNames[0] not in mRebuild:
+                    mRebuild[aNames[0]] = {}
+                mRebuild[aNames[0]][pkg] = ver
     for pkg, info in mRebuild.items():
         for dep, ver in info.items():
-            if vercmp(ver, mVer[dep]) == -1:
+            if getVersionKey(ver) < getVersionKey(mVer[dep]):
                 print('{}{}Need to rebuild {} because of {} {} > {}{}'.format(Fore.YELLOW, Style.BRIGHT, pkg, dep, mVer[dep], ver, Style.RESET_ALL))
 
+def doBuild(*aPath, nWorkers=2, nCPU=None):
+    from .logging import logger
+    from .scheduler import BuildGraph, runBuild
+    catalog = getCatalog()
+    aInfo = []
+    for path in aPath:
+        aInfo += catalog.scan(path)
+    graph = BuildGraph(aInfo)
+    logger.info("Building {:d} units with {:d} workers".format(len(graph), nWorkers))
+    aFailed = runBuild(graph, nWorkers=nWorkers, nCPU=nCPU)
+    if len(aFailed) > 0:
+        return 1
+    return 0
+
+def doFetch(*aPath, nthreads=8, nPerHost=2):
+    from .catalog import loadRecipe
+    from .download import fetchAll
+    from .logging import logger
+    aTask = []
+    mModule = {}
+    for path in aPath:
+        for info in getCatalog().scan(path):
+            if len(info['name']) == 0:
+                continue
+            if info['file'] not in mModule:
+                mModule[info['file']] = loadRecipe(info['file'])
+            aTask += getattr(mModule[info['file']], info['cls'])().getDownloadTasks()
+    logger.info("Fetching sources of {:d} units".format(len(mModule)))
+    aFailed = fetchAll(aTask, nthreads=nthreads, nPerHost=nPerHost)
+    if len(aFailed) > 0:
+        return 1
+    return 0
+
 def main():
     sys.stderr.write("sys.argv = {}\n".format(sys.argv))
     nameArgv0 = sys.argv.pop(0)
     if len(sys.argv) < 1:
-        sys.stderr.write("Usage: {} add|latest\n".format(nameArgv0))
+        sys.stderr.write("Usage: {} add|build|fetch|latest|rebuild\n".format(nameArgv0))
         return 1
 
     # Add: add packages into a repository
     nameCmd = sys.argv.pop(0)
     if nameCmd == "add":
         aDel = []
-        if len(sys.argv) >= 2 and sys.argv[0] == '-d':
-            sys.argv.pop(0)
-            aDel = sys.argv.pop(0).split(',')
+        lvl = 22
+        budget = 0
+        while len(sys.argv) >= 2 and sys.argv[0] in ('-d', '-l', '-t'):
+            opt = sys.argv.pop(0)
+            if opt == '-d':
+                aDel = sys.argv.pop(0).split(',')
+            elif opt == '-l':
+                lvl = int(sys.argv.pop(0))
+            elif opt == '-t':
+                budget = float(sys.argv.pop(0))
 
         if len(sys.argv) < 2:
-            sys.stderr.write("Usage: {} add [-d pkg1,pkg2,...] <output.files> <input.files> [<pkg1.tar.zst> <pkg2.tar.zst>...]\n".format(nameArgv0))
+            sys.stderr.write("Usage: {} add [-d pkg1,pkg2,...] [-l zstd-level] [-t seconds] <output.files> <input.files> [<pkg1.tar.zst> <pkg2.tar.zst>...]\n".format(nameArgv0))
+            return 3
+        return doAdd(*sys.argv, aDel=aDel, lvl=lvl, budget=budget)
+
+    elif nameCmd == "fetch":
+        nthreads = 8
+        nPerHost = 2
+        while len(sys.argv) >= 2 and sys.argv[0] in ('-j', '-p'):
+            opt = sys.argv.pop(0)
+            if opt == '-j':
+                nthreads = int(sys.argv.pop(0))
+            elif opt == '-p':
+                nPerHost = int(sys.argv.pop(0))
+
+        if len(sys.argv) < 1:
+            sys.stderr.write("Usage: {} fetch [-j threads] [-p per-host] <dir|recipe.py>...\n".format(nameArgv0))
             return 3
-        return doAdd(*sys.argv, aDel=aDel)
+        return doFetch(*sys.argv, nthreads=nthreads, nPerHost=nPerHost)
 
     elif nameCmd == "latest":
+        ttl = 6*3600
+        nthreads = 16
+        while len(sys.argv) >= 2 and sys.argv[0] in ('-t', '-j'):
+            opt = sys.argv.pop(0)
+            if opt == '-t':
+                ttl = float(sys.argv.pop(0))
+            elif opt == '-j':
+                nthreads = int(sys.argv.pop(0))
+
+        if len(sys.argv) < 1:
+            sys.stderr.write("Usage: {} latest [-t cache-ttl-seconds] [-j threads] <dir>\n".format(nameArgv0))
+            return 3
+        return doLatest(*sys.argv, ttl=ttl, nthreads=nthreads)
+
+    elif nameCmd == "build":
+        nWorkers = 2
+        nCPU = None
+        while len(sys.argv) >= 2 and sys.argv[0] in ('-j', '-c'):
+            opt = sys.argv.pop(0)
+            if opt == '-j':
+                nWorkers = int(sys.argv.pop(0))
+            elif opt == '-c':
+                nCPU = int(sys.argv.pop(0))
+
         if len(sys.argv) < 1:
-            sys.stderr.write("Usage: {} latest <dir>\n".format(nameArgv0))
+            sys.stderr.write("Usage: {} build [-j parallel-units] [-c total-cpus] <dir|recipe.py>...\n".format(nameArgv0))
             return 3
-        return doLatest(*sys.argv)
+        return doBuild(*sys.argv, nWorkers=nWorkers, nCPU=nCPU)
 
     elif nameCmd == "rebuild":
         return doRebuild(*sys.argv)
@@ -13,80 +13,261 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+import json
 import os
+import stat
+import tarfile
 import time
-import shutil
+from hashlib import md5, sha256
 from pathlib import Path
 
 import Eikthyr as eik
-import luigi as lg
 
-class TaskPackageInfo(eik.NITask):
-    src = eik.TaskParameter()
+from .stream import SIZE_CHUNK, HashingReader, gzipBytes, openGzipWriter, openZstdWriter
+from .tidy import walkTree
+
+def formatPKGINFO(unit, size, tstamp):
+    aLine = []
+    aLine.append('pkgname = {}\n'.format(unit.name))
+    aLine.append('pkgbase = {}\n'.format(unit.base))
+    aLine.append('pkgver = {}\n'.format(unit.getFullVersion(filename=False)))
+    aLine.append('pkgdesc = {}\n'.format(unit.desc))
+    if unit.url:
+        aLine.append('url = {}\n'.format(unit.url))
+    aLine.append('builddate = {}\n'.format(tstamp))
+    aLine.append('packager = {}\n'.format(unit.packager))
+    aLine.append('size = {}\n'.format(size))
+    aLine.append('arch = {}\n'.format(unit.arch))
+    for n in unit.replaces:
+        aLine.append('replaces = {}\n'.format(n))
+    for n in unit.groups:
+        aLine.append('group = {}\n'.format(n))
+    for n in unit.depends:
+        aLine.append('depend = {}\n'.format(n))
+    return ''.join(aLine)
+
+# Names in mtree files: anything unusual becomes \ooo
+def quoteMTree(name):
+    return ''.join(chr(b) if 0x20 < b < 0x7f and b not in b'#=\\' else '\\{:03o}'.format(b) for b in name.encode('utf-8'))
+
+# Compression profiles: (up to this many bytes of tar, zstd level, extra zstd arguments), the first one fitting the size is used
+# Long distance matching is capped at a 128MiB window (--long=27), the most decompressors accept without being told
+mProfileZstd = {
+        'fast': ((64 << 20, 3, ()), (None, 3, ('--long=27',))),
+        'default': ((1 << 20, 12, ()), (64 << 20, 19, ()), (1 << 30, 19, ('--long=27',)), (None, 15, ('--long=27',))),
+        'max': ((1 << 20, 19, ()), (None, 22, ('--long=27',))),
+        }
+mProfileGzip = {'fast': 6, 'default': 9, 'max': 9}
+
+# Returns (level, extra arguments) for compressing about size bytes
+def pickCompression(profile, size, isGzip=False):
+    if isGzip:
+        return (mProfileGzip[profile], ())
+    for (sizeMax, lvl, aArgs) in mProfileZstd[profile]:
+        if sizeMax == None or size <= sizeMax:
+            return (lvl, aArgs)
+
+# .PKGINFO, .MTREE and the tarball streamed into the compressor, without any intermediate file
+# A manifest of the content (paths, modes, digests) is kept next to the package, so that an unchanged package isn't made again
+class TaskPackage(eik.NITask):
+    src = eik.TaskParameter() # The package directory
     unit = eik.WhateverParameter(significant=False)
+    out = eik.PathParameter()
+    profile = eik.Parameter('default') # See mProfileZstd
+    pathStats = eik.PathParameter('', significant=False, positional=False) # If set: append the achieved ratio and speed here as a json line
+
+    # The entries to be packed as (name, path, stat), and the installed size
+    def scanTree(self):
+        aEntry = []
+        size = 0
+        sInode = set()
+        for (rel, ent) in walkTree(self.input().path):
+            if rel in ('.PKGINFO', '.MTREE'): continue # Left there by older versions
+            st = ent.stat(follow_symlinks=False)
+            aEntry.append((rel, ent.path, st))
+            if stat.S_ISREG(st.st_mode) and (st.st_dev, st.st_ino) not in sInode: # Hardlinks take the space only once
+                if st.st_nlink > 1:
+                    sInode.add((st.st_dev, st.st_ino))
+                size += st.st_size
+        # Metadata like .INSTALL goes first, as makepkg does
+        aEntry.sort(key=lambda e: '/' in e[0] or not e[0].startswith('.'))
+        return (aEntry, size)
+
+    def getTarInfo(self, name, mode, tstamp):
+        info = tarfile.TarInfo(name)
+        info.mode = mode
+        info.mtime = tstamp
+        info.uid = info.gid = 0
+        info.uname = info.gname = 'root'
+        return info
+
+    def isGzip(self):
+        return str(self.out).endswith('.gz')
+
+    def openWriter(self, path, lvl, aArgs):
+        if self.isGzip():
+            return openGzipWriter(path, lvl, ('--rsyncable', *aArgs))
+        return openZstdWriter(path, lvl, ('--rsyncable', *aArgs))
+
+    def writeStats(self, lvl, aArgs, size, sizeComp, t):
+        mbps = size / 1e6 / max(t, 1e-6)
+        self.logger.info('Packed {:d} bytes into {:d} ({:.1f}%) at {:.1f} MB/s, {} level {:d}{}'.format(
+            size, sizeComp, 100 * sizeComp / max(size, 1), mbps, 'gzip' if self.isGzip() else 'zstd', lvl, ''.join(' ' + a for a in aArgs)))
+        if not self.pathStats: return
+        mStats = {
+                'name': self.unit.name,
+                'ver': self.unit.getFullVersion(filename=False),
+                'file': Path(self.out).name,
+                'profile': self.profile,
+                'level': lvl,
+                'args': list(aArgs),
+                'size': size,
+                'compressed': sizeComp,
+                'ratio': round(sizeComp / max(size, 1), 4),
+                'seconds': round(t, 3),
+                'mbps': round(mbps, 2),
+                'time': int(time.time()),
+                }
+        Path(self.pathStats).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.pathStats, 'a') as fpw: # One short write, so concurrent builds don't mix their lines
+            fpw.write('{}\n'.format(json.dumps(mStats, sort_keys=True)))
 
-    def generates(self):
-        return eik.Target(self, Path(self.src.output().path) / '.PKGINFO')
+    def getPathManifest(self):
+        return '{}.manifest'.format(self.out)
+
+    def loadManifest(self):
+        try:
+            with open(self.getPathManifest()) as fp:
+                return json.load(fp)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    # What the package would contain, as [name, kind, mode, size, link target or [md5, sha256]]
+    # Digests of files which didn't change since the last manifest are taken from there, the others are left as None for fillDigests()
+    def getManifest(self, aEntry, size, mOld):
+        mStatOld = mOld.get('stat', {})
+        mDigestOld = {ent[0]: ent[4] for ent in mOld.get('entries', ()) if ent[1] == 'file'}
+        aManifest = []
+        mStat = {} # name -> the stat which the digest is valid for
+        mLink = {} # (device, inode) -> name of the first one seen
+        for (name, path, st) in aEntry:
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                aManifest.append([name, 'dir', mode, 0, ''])
+            elif stat.S_ISLNK(st.st_mode):
+                aManifest.append([name, 'link', mode, 0, os.readlink(path)])
+            elif stat.S_ISREG(st.st_mode):
+                key = (st.st_dev, st.st_ino)
+                if st.st_nlink > 1 and key in mLink:
+                    aManifest.append([name, 'hardlink', mode, st.st_size, mLink[key]])
+                    continue
+                mLink[key] = name
+                mStat[name] = [st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_ino]
+                aDigest = None
+                if mStatOld.get(name) == mStat[name] and name in mDigestOld:
+                    aDigest = mDigestOld[name]
+                aManifest.append([name, 'file', mode, st.st_size, aDigest])
+            else:
+                self.logger.warning('Not packing {}: only files, directories and symlinks are supported'.format(name))
+        return {
+                'info': formatPKGINFO(self.unit, size, 0), # Everything but the build date
+                'compression': self.profile,
+                'entries': aManifest,
+                'stat': mStat,
+                }
+
+    # Hash the files the manifest doesn't have digests for yet
+    def fillDigests(self, mManifest):
+        pathTop = self.input().path
+        for ent in mManifest['entries']:
+            if ent[1] != 'file' or ent[4] != None: continue
+            hMD5 = md5()
+            hSHA256 = sha256()
+            with open(os.path.join(pathTop, ent[0]), 'rb') as fp:
+                HashingReader(fp, hMD5, hSHA256).drain()
+            ent[4] = [hMD5.hexdigest(), hSHA256.hexdigest()]
+
+    # The last package can be kept if it was made from the same things, and nobody touched it since
+    def isReusable(self, mManifest, mOld):
+        if not Path(self.out).exists() or 'out' not in mOld: return False
+        st = Path(self.out).stat()
+        if mOld['out'] != [st.st_size, st.st_mtime_ns]: return False
+        return all(mManifest[key] == mOld.get(key) for key in ('info', 'compression', 'entries'))
+
+    def saveManifest(self, mManifest):
+        st = Path(self.out).stat()
+        mManifest['out'] = [st.st_size, st.st_mtime_ns]
+        pathTmp = '{}.{:d}'.format(self.getPathManifest(), os.getpid())
+        with open(pathTmp, 'w') as fpw:
+            json.dump(mManifest, fpw)
+        os.replace(pathTmp, self.getPathManifest())
+
+    # The gzipped .MTREE, from the manifest with all the digests filled
+    def formatMTree(self, mManifest, dataInfo, tstamp):
+        aMTree = ['#mtree', '/set type=file uid=0 gid=0 mode=644']
+        aMTree.append('./.PKGINFO time={:d}.0 size={:d} md5digest={} sha256digest={}'.format(tstamp, len(dataInfo), md5(dataInfo).hexdigest(), sha256(dataInfo).hexdigest()))
+        mDigest = {} # name -> [md5, sha256], for hardlinks
+        for (name, kind, mode, sizeFile, extra) in mManifest['entries']:
+            line = './{} time={:d}.0'.format(quoteMTree(name), tstamp)
+            if kind == 'dir':
+                aMTree.append('{} mode={:o} type=dir'.format(line, mode))
+                continue
+            if kind == 'link':
+                aMTree.append('{} mode={:o} type=link link={}'.format(line, mode, quoteMTree(extra)))
+                continue
+            if kind == 'hardlink':
+                (digestMD5, digestSHA256) = mDigest[extra]
+            else:
+                (digestMD5, digestSHA256) = mDigest[name] = extra
+            if mode != 0o644:
+                line = '{} mode={:o}'.format(line, mode)
+            aMTree.append('{} size={:d} md5digest={} sha256digest={}'.format(line, sizeFile, digestMD5, digestSHA256))
+        return gzipBytes('{}\n'.format('\n'.join(aMTree)).encode('utf-8'))
 
     def task(self):
+        (aEntry, size) = self.scanTree()
+        mOld = self.loadManifest()
+        mManifest = self.getManifest(aEntry, size, mOld)
+        # .MTREE goes right after .PKGINFO as makepkg does, so that pacman finds it without reading the whole package
+        # So every digest is needed before packing: files which changed are hashed here, and read again (from the page cache) into the tar
+        self.fillDigests(mManifest)
+        if self.isReusable(mManifest, mOld):
+            self.logger.info('Package content unchanged, keeping {}'.format(self.out))
+            return
+
         tstamp = int(time.time())
-        size = 0
-        for f in Path(self.input().path).glob('**/*'):
-            os.utime(f, (tstamp, tstamp))
-            if f.is_file():
-                size += f.stat().st_size
-
-        with self.output().fpWrite() as fpw:
-            fpw.write('pkgname = {}\n'.format(self.unit.name))
-            fpw.write('pkgbase = {}\n'.format(self.unit.base))
-            fpw.write('pkgver = {}\n'.format(self.unit.getFullVersion(filename=False)))
-            fpw.write('pkgdesc = {}\n'.format(self.unit.desc))
-            if self.unit.url:
-                fpw.write('url = {}\n'.format(self.unit.url))
-            fpw.write('builddate = {}\n'.format(tstamp))
-            fpw.write('packager = {}\n'.format(self.unit.packager))
-            fpw.write('size = {}\n'.format(size))
-            fpw.write('arch = {}\n'.format(self.unit.arch))
-            for n in self.unit.replaces:
-                fpw.write('replaces = {}\n'.format(n))
-            for n in self.unit.groups:
-                fpw.write('group = {}\n'.format(n))
-            for n in self.unit.depends:
-                fpw.write('depend = {}\n'.format(n))
-        os.utime(self.output().path, (tstamp, tstamp))
-
-
-class TaskPackageMTree(eik.NITask):
-    src = eik.TaskParameter() # Presumbly this is the .PKGINFO file
-
-    def generates(self):
-        return eik.Target(self, Path(self.src.output().path).parent / '.MTREE')
+        pathTop = self.input().path
+        dataInfo = formatPKGINFO(self.unit, size, tstamp).encode('utf-8')
+        dataMTree = self.formatMTree(mManifest, dataInfo, tstamp)
 
-    def task(self):
-        with eik.chdir(Path(self.input().path).parent):
-            with eik.withEnv(LANG='C', LC_ALL='C'):
-                with self.output().pathWrite() as fw:
-                    basename = str(Path(fw).name)
-                    self.ex(
-                            eik.cmd.bsdtar['-cf', '-', '--format=mtree', '--options=!all,use-set,type,uid,gid,mode,time,size,md5,sha256,link', '--exclude', basename, '--exclude', '.MTREE', '.']
-                            | eik.cmd.grep['-Ev', '^\\. ']
-                            | eik.cmd.gzip['-nc', '-9'] > basename
-                            )
-        tstamp = Path(self.input().path).stat().st_mtime
-        os.utime(self.output().path, (tstamp, tstamp))
-
-class TaskPackageTar(eik.NITask):
-    src = eik.TaskParameter() # Presumbly this is the .MTREE file
-    out = eik.PathParameter()
-    lvl = eik.IntParameter(19)
+        (lvl, aArgs) = pickCompression(self.profile, size, self.isGzip())
+        timeStart = time.time()
+        with self.output().pathWrite() as fw:
+            with self.openWriter(fw, lvl, aArgs) as fpw:
+                with tarfile.open(fileobj=fpw, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                    tar.copybufsize = SIZE_CHUNK
+                    for (name, data) in (('.PKGINFO', dataInfo), ('.MTREE', dataMTree)):
+                        info = self.getTarInfo(name, 0o644, tstamp)
+                        info.size = len(data)
+                        tar.addfile(info, io.BytesIO(data))
 
-    def task(self):
-        dirPkg = str(Path(self.input().path).parent)
-        with eik.withEnv(LANG='C', LC_ALL='C'):
-            with self.output().pathWrite() as fw:
-                self.ex(eik.cmd.bsdtar['-cf', '{}.tar'.format(fw), '--no-xattrs', '--strip-components', '1', '-C', dirPkg, '.'])
-                if self.output().path.endswith('.gz'):
-                    self.ex(eik.cmd.gzip['--rsyncable', '-9', '{}.tar'.format(fw)])
-                    shutil.move('{}.tar.gz'.format(fw), fw)
-                else:
-                    self.ex(eik.cmd.zstd['--rsyncable', '-T0', '--ultra', '--rm', '-{:d}'.format(self.lvl), '{}.tar'.format(fw), '-fo', fw])
+                    for (name, kind, mode, sizeFile, extra) in mManifest['entries']:
+                        info = self.getTarInfo(name, mode, tstamp)
+                        if kind == 'dir':
+                            info.type = tarfile.DIRTYPE
+                            tar.addfile(info)
+                        elif kind == 'link':
+                            info.type = tarfile.SYMTYPE
+                            info.linkname = extra
+                            tar.addfile(info)
+                        elif kind == 'hardlink':
+                            info.type = tarfile.LNKTYPE
+                            info.linkname = extra
+                            tar.addfile(info)
+                        else:
+                            info.size = sizeFile
+                            with open(os.path.join(pathTop, name), 'rb') as fp:
+                                tar.addfile(info, fp)
+            self.writeStats(lvl, aArgs, tar.offset, os.path.getsize(fw), time.time() - timeStart)
+        self.saveManifest(mManifest)
@@ -13,142 +13,200 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import shutil
 import sys
-from functools import cmp_to_key
+import tarfile
 from hashlib import md5, sha256
 from pathlib import Path
 
 import Eikthyr as eik
 
-from .unit import UnitConfig, Unit
-from .ver import vercmp
+from .index import RepoIndex, getFileDigest, writeRepoArchives
+from .repomodel import RepoModel
+from .stream import HashingReader, openDecompressed, openZstdWriter, pickZstdLevel
+from .unit import Unit
+
+# Read through a package once: compute the digests, parse .PKGINFO, and give each path in it to addFile
+def scanPackage(pathPkg, addFile):
+    hMD5 = md5()
+    hSHA256 = sha256()
+    unitPkg = None
+    with Path(pathPkg).open('rb') as fp:
+        fpHash = HashingReader(fp, hMD5, hSHA256)
+        with openDecompressed(fpHash, pathPkg) as fpTar:
+            with tarfile.open(fileobj=fpTar, mode='r|') as tar:
+                for info in tar:
+                    name = info.name.removeprefix('./')
+                    if name == '.PKGINFO':
+                        unitPkg = Unit().loadPKGINFO(tar.extractfile(info).read().decode('utf-8').splitlines())
+                    if len(name) == 0 or name.startswith('.'): continue
+                    if info.isdir():
+                        name = '{}/'.format(name)
+                    addFile(name)
+        fpHash.drain()
+    if unitPkg == None:
+        raise RuntimeError("No .PKGINFO found in {}".format(pathPkg))
+    return (unitPkg, hMD5.hexdigest(), hSHA256.hexdigest())
+
+def formatDesc(pathPkg, unitPkg, hashMD5, hashSHA256):
+    aDesc = []
+    aDesc.append('%FILENAME%\n{}\n\n'.format(pathPkg.name))
+    aDesc.append('%NAME%\n{}\n\n'.format(unitPkg.name))
+    aDesc.append('%BASE%\n{}\n\n'.format(unitPkg.base))
+    aDesc.append('%VERSION%\n{}\n\n'.format(unitPkg.fullver))
+    aDesc.append('%DESC%\n{}\n\n'.format(unitPkg.desc))
+    if len(unitPkg.groups) > 0:
+        aDesc.append('%GROUPS%\n{}\n\n'.format('\n'.join(unitPkg.groups)))
+    aDesc.append('%CSIZE%\n{}\n\n'.format(pathPkg.stat().st_size))
+    aDesc.append('%ISIZE%\n{}\n\n'.format(unitPkg.size))
+
+    aDesc.append('%MD5SUM%\n{}\n\n'.format(hashMD5))
+    aDesc.append('%SHA256SUM%\n{}\n\n'.format(hashSHA256))
+
+    if unitPkg.url:
+        aDesc.append('%URL%\n{}\n\n'.format(unitPkg.url))
+    aDesc.append('%ARCH%\n{}\n\n'.format(unitPkg.arch))
+    aDesc.append('%BUILDDATE%\n{}\n\n'.format(unitPkg.builddate))
+    aDesc.append('%PACKAGER%\n{}\n\n'.format(unitPkg.packager))
+
+    if len(unitPkg.replaces) > 0:
+        aDesc.append('%REPLACES%\n{}\n\n'.format('\n'.join(unitPkg.replaces)))
+    if len(unitPkg.depends) > 0:
+        aDesc.append('%DEPENDS%\n{}\n\n'.format('\n'.join(unitPkg.depends)))
+    return ''.join(aDesc)
 
-class TaskExtractDB(eik.Task):
-    src = eik.TaskParameter() # Presumbly this is the db file
-    out = eik.PathParameter()
+class TaskRepoFileList(eik.Task):
+    src = eik.TaskParameter() # Repo directory
+    out = eik.PathParameter() # Output: A file containing the list of package file
 
     def task(self):
-        with self.output().pathWrite() as fw:
-            Path(fw).mkdir(parents=True, exist_ok=True)
-            self.ex(eik.cmd.bsdtar['xf', self.input().path, '--zstd', '-C', fw])
+        with self.output().fpWrite() as fpw:
+            for ent in RepoModel.fromDirectory(self.input().path):
+                fpw.write('{}\n'.format(ent.filename))
+
+# Find out what to delete from a repo: everything named in aDel, and all the outdated versions
+def getRepoDeletion(model, aDel):
+    aDelete = []
+    for name in aDel:
+        aDelete += model.getByName(name)
+    setDelete = set(aDelete)
+    aDelete += [ent for ent in model.getOutdated() if ent not in setDelete]
+    return aDelete
+
+# Make sure the persistent index reflects the original "files" file, only re-importing it when it changed
+class TaskSyncIndex(eik.Task):
+    src = eik.TaskParameter() # The original "files" file
+    out = eik.PathParameter() # The index
+
+    checkOutputHash = False # The index changes all the time
+
+    def complete(self):
+        if getattr(self, 'isSynced', False): # The index will move on after this task within the same run
+            return True
+        if not Path(self.out).exists() or not Path(self.src.output().path).exists():
+            return False
+        with RepoIndex(self.out) as index:
+            self.isSynced = index.isArchiveCurrent(getFileDigest(self.src.output().path))
+        return self.isSynced
 
-class TaskMakeRepoDesc(eik.Task):
+    def task(self):
+        self.logger.info("Re-importing {} into the index".format(self.input().path))
+        with RepoIndex(self.output().path) as index:
+            index.importArchive(self.input().path)
+            index.setArchive(getFileDigest(self.input().path))
+        self.isSynced = True
+
+class TaskIndexPackage(eik.Task):
     src = eik.TaskParameter() # Presumbly this is the package file
-    taskOut = eik.TaskParameter() # ExtractDB
+    taskOut = eik.TaskParameter() # SyncIndex
 
     def requires(self):
         return (self.src, self.taskOut)
 
-    def generates(self):
-        pathOut = Path(self.taskOut.output().path) / Path(self.src.output().path).name.rpartition('-')[0]
-        return (eik.Target(self, pathOut / 'desc'), eik.Target(self, pathOut / 'files'))
+    def getPackageHash(self):
+        st = Path(self.src.output().path).stat()
+        return '{:d}:{:d}'.format(st.st_size, st.st_mtime_ns)
 
-    def task(self):
-        pathPkg = Path(self.input()[0].path)
-        with eik.cmd.bsdtar.popen(('xOqf', str(pathPkg), '--zstd', '.PKGINFO'), encoding='utf-8') as p:
-            unitPkg = Unit().loadPKGINFO(p.stdout)
-        with self.output()[0].fpWrite() as fpw:
-            fpw.write('%FILENAME%\n{}\n\n'.format(pathPkg.name))
-            fpw.write('%NAME%\n{}\n\n'.format(unitPkg.name))
-            fpw.write('%BASE%\n{}\n\n'.format(unitPkg.base))
-            fpw.write('%VERSION%\n{}\n\n'.format(unitPkg.fullver))
-            fpw.write('%DESC%\n{}\n\n'.format(unitPkg.desc))
-            if len(unitPkg.groups) > 0:
-                fpw.write('%GROUPS%\n{}\n\n'.format('\n'.join(unitPkg.groups)))
-            fpw.write('%CSIZE%\n{}\n\n'.format(pathPkg.stat().st_size))
-            fpw.write('%ISIZE%\n{}\n\n'.format(unitPkg.size))
-
-            fpw.write('%MD5SUM%\n{}\n\n'.format(md5(pathPkg.read_bytes()).hexdigest()))
-            fpw.write('%SHA256SUM%\n{}\n\n'.format(sha256(pathPkg.read_bytes()).hexdigest()))
-
-            if unitPkg.url:
-                fpw.write('%URL%\n{}\n\n'.format(unitPkg.url))
-            fpw.write('%ARCH%\n{}\n\n'.format(unitPkg.arch))
-            fpw.write('%BUILDDATE%\n{}\n\n'.format(unitPkg.builddate))
-            fpw.write('%PACKAGER%\n{}\n\n'.format(unitPkg.packager))
-
-            if len(unitPkg.replaces) > 0:
-                fpw.write('%REPLACES%\n{}\n\n'.format('\n'.join(unitPkg.replaces)))
-            if len(unitPkg.depends) > 0:
-                fpw.write('%DEPENDS%\n{}\n\n'.format('\n'.join(unitPkg.depends)))
-        with self.output()[1].fpWrite() as fpw:
-            fpw.write('%FILES%\n')
-            with eik.withEnv(LANG='C', LC_ALL='C'):
-                with eik.cmd.bsdtar.popen(('tf', str(pathPkg), '--exclude=^.*'), encoding='utf-8') as p:
-                    fpw.write(p.stdout.read())
-
-class TaskRepoFileList(eik.Task):
-    src = eik.TaskParameter() # Repo directory
-    out = eik.PathParameter() # Output: A file containing the list of package file
+    def complete(self):
+        if getattr(self, 'isAdded', False): # Cleanup may remove it again within the same run
+            return True
+        if not self.taskOut.complete() or not Path(self.src.output().path).exists():
+            return False
+        with RepoIndex(self.taskOut.output().path) as index:
+            return index.hasPackage(Path(self.src.output().path).name, self.getPackageHash())
 
     def task(self):
-        hVer = {}
-        hDir = {} # key="pkgname fullver"
-        hFile = {} # key="pkgname fullver"
-        aDelete = []
-        with self.output().fpWrite() as fpw:
-            with eik.chdir(self.input().path):
-                for d in Path('.').iterdir():
-                    if not d.is_dir(): continue
-                    if not (d / 'desc').exists(): continue
-                    with (d / 'desc').open() as fp:
-                        aInfo = [l.strip() for l in fp.readlines()]
-                    fpw.write('{}\n'.format(aInfo[aInfo.index('%FILENAME%')+1]))
-
-class TaskCleanupRepo(eik.Task):
-    src = eik.TaskParameter() # Repo directory
+        pathPkg = Path(self.input()[0].path)
+        dirname = pathPkg.name.rpartition('-')[0]
+        with RepoIndex(self.input()[1].path) as index:
+            # The paths go into the index as the package streams by, the whole list is never in memory
+            index.putFiles(dirname)
+            unitPkg, hashMD5, hashSHA256 = scanPackage(pathPkg, lambda name: index.addFile(dirname, name))
+            index.put(dirname, formatDesc(pathPkg, unitPkg, hashMD5, hashSHA256), srchash=self.getPackageHash())
+        self.isAdded = True
+
+class TaskCleanupIndex(eik.Task):
+    src = eik.TaskParameter() # SyncIndex
     out = eik.PathParameter() # Output: A file containing the list of file to delete
     aDel = eik.ListParameter([], positional=False) # A list of packages to delete
 
+    def complete(self):
+        if not all(t.complete() for t in self.prev) or not self.src.complete() or not Path(self.out).exists():
+            return False
+        with RepoIndex(self.src.output().path) as index:
+            return index.getMeta('cleanup:{}'.format(repr(self))) == str(index.getGeneration())
+
     def task(self):
-        hVer = {}
-        hDir = {} # key="pkgname fullver"
-        hFile = {} # key="pkgname fullver"
-        aDelete = []
-        with eik.chdir(self.input().path):
-            for d in Path('.').iterdir():
-                if not d.is_dir(): continue
-                if not (d / 'desc').exists(): continue
-                with (d / 'desc').open() as fp:
-                    aInfo = [l.strip() for l in fp.readlines()]
-                fname = aInfo[aInfo.index('%FILENAME%')+1]
-                namePkg = aInfo[aInfo.index('%NAME%')+1]
-                verPkg = aInfo[aInfo.index('%VERSION%')+1]
-                if namePkg not in hVer:
-                    hVer[namePkg] = []
-                hVer[namePkg].append(verPkg)
-                hDir['{} {}'.format(namePkg, verPkg)] = str(d)
-                hFile['{} {}'.format(namePkg, verPkg)] = fname
-            for (namePkg, aVer) in hVer.items():
-                if namePkg not in self.aDel: continue
-                for v in aVer:
-                    self.logger.debug("Delete package: {}-{}".format(namePkg, v))
-                    shutil.rmtree(hDir['{} {}'.format(namePkg, v)])
-                    aDelete.append(hFile['{} {}'.format(namePkg, v)])
-            for (namePkg, aVer) in hVer.items():
-                if len(aVer) == 1: continue
-                for v in sorted(aVer, key=cmp_to_key(vercmp), reverse=True)[1:]:
-                    if hFile['{} {}'.format(namePkg, v)] in aDelete: continue
-                    self.logger.debug("Found outdated package: {}-{}".format(namePkg, v))
-                    shutil.rmtree(hDir['{} {}'.format(namePkg, v)])
-                    aDelete.append(hFile['{} {}'.format(namePkg, v)])
-        with self.output().fpWrite() as fpw:
-            for f in set(aDelete):
-                fpw.write('{}\n'.format(f))
+        with RepoIndex(self.input().path) as index:
+            aDelete = getRepoDeletion(RepoModel.fromIndex(index), self.aDel)
+            for ent in aDelete:
+                self.logger.debug("Delete package: {}-{}".format(ent.name, ent.version))
+                index.remove(ent.name, ent.version)
+            index.commit()
+            with self.output().fpWrite() as fpw:
+                for f in set(ent.filename for ent in aDelete):
+                    fpw.write('{}\n'.format(f))
+            index.setMeta('cleanup:{}'.format(repr(self)), index.getGeneration())
+
+# Regenerate the db/files archives straight from the index, without extracting anything
+class TaskPackIndex(eik.Task):
+    src = eik.TaskParameter() # SyncIndex
+    out = eik.PathParameter() # The output "db" file
+    out2 = eik.PathParameter() # The output "files" file
+    lvl = eik.IntParameter(22, significant=False, positional=False) # zstd compression level
+    budget = eik.FloatParameter(0, significant=False, positional=False) # If >0: lower the level to fit into this many seconds
 
-class TaskPackDB(eik.Task):
-    src = eik.TaskParameter() # Presumbly this is the extracted db directory
-    out = eik.PathParameter()
-    dbonly = eik.BoolParameter()
+    def generates(self):
+        return (eik.Target(self, self.out), eik.Target(self, self.out2))
+
+    def getLevel(self, size):
+        lvl = pickZstdLevel(size, self.lvl, self.budget)
+        if lvl != self.lvl:
+            self.logger.info("Using zstd level {:d} to fit into {:.0f}s".format(lvl, self.budget))
+        return lvl
+
+    # Walk the entries once, feeding both compressors at the same time
+    def packEntries(self, aEntries, size):
+        lvl = self.getLevel(size)
+        with self.output()[0].pathWrite() as fw:
+            with self.output()[1].pathWrite() as fw2:
+                with openZstdWriter(fw, lvl, ('--rsyncable',)) as fpDB:
+                    with openZstdWriter(fw2, lvl, ('--rsyncable',)) as fpFiles:
+                        writeRepoArchives(aEntries, fpDB, fpFiles)
+
+    def complete(self):
+        if not all(t.complete() for t in self.prev) or not self.src.complete():
+            return False
+        if not Path(self.out).exists() or not Path(self.out2).exists():
+            return False
+        with RepoIndex(self.src.output().path) as index:
+            return index.getMeta('packed:{}'.format(self.out)) == str(index.getGeneration())
 
     def task(self):
-        with self.output().pathWrite() as fw:
-            if self.dbonly:
-                objTar = eik.cmd.bsdtar['-cf', '-', '--exclude', 'files', '--strip-components', '1', '-C', self.input().path, '.']
-            else:
-                objTar = eik.cmd.bsdtar['-cf', '-', '--strip-components', '1', '-C', self.input().path, '.']
-            self.ex(objTar | eik.cmd.zstd['--rsyncable', '-cT0', '--ultra', '-22'] > fw)
+        with RepoIndex(self.input().path) as index:
+            self.packEntries(index.iterEntries(), index.getSize())
+            # The next run reading this file won't need to re-import it
+            index.setArchive(getFileDigest(self.out2))
+            index.setMeta('packed:{}'.format(self.out), index.getGeneration())
 
 
 class TaskRepoAdd(eik.Task):
@@ -157,26 +215,30 @@ class TaskRepoAdd(eik.Task):
     src = eik.TaskParameter() # The original "files" file
     pkg = eik.TaskListParameter() # All packages
     aDel = eik.ListParameter([], positional=False) # A list of packages to delete
+    lvl = eik.IntParameter(22, significant=False, positional=False) # zstd compression level
+    budget = eik.FloatParameter(0, significant=False, positional=False) # If >0: lower the level to fit into this many seconds
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        tDir = TaskExtractDB(self.src, Path(UnitConfig().pathBuild) / '.db')
-        aTaskDesc = [TaskMakeRepoDesc(p, tDir) for p in self.pkg]
+        tIndex = TaskSyncIndex(self.src, '{}.index'.format(str(self.out).removesuffix('.db')))
+        aTaskIndex = [TaskIndexPackage(p, tIndex) for p in self.pkg]
 
-        self.tClean = TaskCleanupRepo(tDir, '{}.cleanup'.format(self.out), aDel=self.aDel, prev=aTaskDesc)
-        self.tPack = TaskPackDB(tDir, self.out, prev=(self.tClean,), dbonly=True)
-        self.tPack2 = TaskPackDB(tDir, self.out2, prev=(self.tClean,))
+        self.tClean = TaskCleanupIndex(tIndex, '{}.cleanup'.format(self.out), aDel=self.aDel, prev=aTaskIndex)
+        self.tPack = TaskPackIndex(tIndex, self.out, self.out2, prev=(self.tClean,), lvl=self.lvl, budget=self.budget)
 
     def requires(self):
         return (self.src, self.pkg)
 
+    # The real state lives in the index, so ask the sub-tasks as well
+    def complete(self):
+        return super().complete() and self.tPack.complete()
+
     def generates(self):
         return (
-                eik.Target(self, self.tPack.output().path),
-                eik.Target(self, self.tPack2.output().path),
+                eik.Target(self, self.tPack.output()[0].path),
+                eik.Target(self, self.tPack.output()[1].path),
                 eik.Target(self, self.tClean.output().path),
                 )
 
     def task(self):
         yield self.tPack
-        yield self.tPack2
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from .index import parseDesc
+from .ver import newest
+
+RepoEntry = namedtuple('RepoEntry', ('name', 'version', 'filename', 'dirname'))
+
+def readDescDir(d):
+    pathDesc = Path(d) / 'desc'
+    if not pathDesc.is_file():
+        return None
+    mInfo = parseDesc(pathDesc.read_text('utf-8'))
+    return RepoEntry(mInfo['NAME'][0], mInfo['VERSION'][0], mInfo['FILENAME'][0], Path(d).name)
+
+# All the packages in a repo, with lookups by name and version
+class RepoModel(object):
+    def __init__(self, aEntry=()):
+        self.aEntry = []
+        self.mByName = {}
+        self.mNewest = None
+        for ent in aEntry:
+            self.add(ent)
+
+    # Parse all the desc files under an extracted repo directory, with nthreads workers (None: decided by python)
+    @classmethod
+    def fromDirectory(cls, path, nthreads=None):
+        aDir = [d for d in Path(path).iterdir() if d.is_dir()]
+        if nthreads == 1:
+            aEntry = map(readDescDir, aDir)
+        else:
+            with ThreadPoolExecutor(nthreads) as executor:
+                aEntry = list(executor.map(readDescDir, aDir, chunksize=64))
+        return cls(ent for ent in aEntry if ent != None)
+
+    @classmethod
+    def fromIndex(cls, index):
+        return cls(RepoEntry(name, version, filename, dirname) for (name, version, filename, dirname) in index.iterVersions())
+
+    def __iter__(self):
+        return iter(self.aEntry)
+
+    def __len__(self):
+        return len(self.aEntry)
+
+    def add(self, ent):
+        self.aEntry.append(ent)
+        self.mByName.setdefault(ent.name, []).append(ent)
+        self.mNewest = None
+
+    def getByName(self, name):
+        return self.mByName.get(name, [])
+
+    # Returns {name: entry} of the newest version of each package
+    def getNewest(self):
+        if self.mNewest == None:
+            self.mNewest = {}
+            for (name, aEnt) in self.mByName.items():
+                if len(aEnt) == 1:
+                    self.mNewest[name] = aEnt[0]
+                else:
+                    self.mNewest[name] = newest(aEnt, key=lambda ent: ent.version)
+        return self.mNewest
+
+    # Returns the entries which are not the newest version of their package
+    def getOutdated(self):
+        mNewest = self.getNewest()
+        return [ent for ent in self.aEntry if mNewest[ent.name] is not ent]
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import multiprocessing
+import os
+import re
+import time
+from multiprocessing.connection import wait
+
+import Eikthyr as eik
+
+from .catalog import loadRecipe
+from .jobserver import JobServer
+from .logging import logger
+
+# Package names provided by a catalog entry
+def getNames(info):
+    if isinstance(info['name'], str):
+        return (info['name'],)
+    return tuple(info['name'])
+
+# 'foo>=1.0' -> 'foo', 'foo 1.0-1' -> 'foo'
+def getDepName(dep):
+    return re.split(R'[<>= ]', dep, maxsplit=1)[0]
+
+def getUnitLabel(info):
+    return '{}:{}'.format(info['file'], info['cls'])
+
+# Dependency graph between recipes, built from their depends and _rebuild
+class BuildGraph(object):
+    def __init__(self, aInfo):
+        self.aInfo = [info for info in aInfo if len(info['name']) > 0]
+        self.mProvider = {} # package name -> index of the unit building it
+        for (i, info) in enumerate(self.aInfo):
+            for name in getNames(info):
+                self.mProvider[name] = i
+
+        self.aDeps = []
+        for (i, info) in enumerate(self.aInfo):
+            aDep = list(info['depends'])
+            if info['_rebuild'] != None:
+                if isinstance(info['_rebuild'], str):
+                    aDep.append(info['_rebuild'])
+                else:
+                    aDep += info['_rebuild']
+            # Only the dependencies built in this run count, anything else is assumed to be already there
+            sDep = {self.mProvider[getDepName(dep)] for dep in aDep if getDepName(dep) in self.mProvider}
+            sDep.discard(i)
+            self.aDeps.append(sDep)
+
+        self.aRDeps = [set() for _ in self.aInfo]
+        for (i, sDep) in enumerate(self.aDeps):
+            for j in sDep:
+                self.aRDeps[j].add(i)
+
+    def __len__(self):
+        return len(self.aInfo)
+
+    # A topological order of all units, raise if there's a cycle
+    def getOrder(self):
+        aCount = [len(sDep) for sDep in self.aDeps]
+        aReady = [i for (i, n) in enumerate(aCount) if n == 0]
+        aOrder = []
+        while len(aReady) > 0:
+            i = aReady.pop()
+            aOrder.append(i)
+            for j in self.aRDeps[i]:
+                aCount[j] -= 1
+                if aCount[j] == 0:
+                    aReady.append(j)
+        if len(aOrder) < len(self.aInfo):
+            aCycle = [getUnitLabel(self.aInfo[i]) for (i, n) in enumerate(aCount) if n > 0]
+            raise RuntimeError("Dependency cycle among {}".format(', '.join(aCycle)))
+        return aOrder
+
+    # Everything depending on unit i, directly or not
+    def getDownstream(self, i):
+        sRslt = set()
+        aStack = [i]
+        while len(aStack) > 0:
+            for j in self.aRDeps[aStack.pop()]:
+                if j not in sRslt:
+                    sRslt.add(j)
+                    aStack.append(j)
+        return sRslt
+
+# Runs inside a fresh process: working directory and luigi's state are process-wide
+def buildUnit(path, nameCls):
+    # The unit gets pickled into task parameters, so its module must be findable by name
+    mod = loadRecipe(path, "__ixal_recipe__")
+    getattr(mod, nameCls)().make()
+
+# Build all units in the graph, at most nWorkers at a time, with nCPU cores shared among them
+# A unit starts as soon as everything it depends on is packaged
+# make and ninja take their jobs from one jobserver, so a unit can use the cores left idle by the others
+# Returns the list of units which failed or were skipped because of a failure
+def runBuild(graph, nWorkers=2, nCPU=None):
+    if nCPU == None:
+        nCPU = os.cpu_count() or 1
+    graph.getOrder()
+    ctx = multiprocessing.get_context('spawn')
+    aCount = [len(sDep) for sDep in graph.aDeps]
+    aReady = sorted((i for (i, n) in enumerate(aCount) if n == 0), reverse=True)
+    mRunning = {} # sentinel -> (index, process, start time)
+    sFailed = set()
+    sSkipped = set()
+
+    # Every client make holds one job without asking the jobserver, so the pool has the rest of the cores
+    with JobServer(max(0, nCPU - nWorkers)) as js, \
+            eik.withEnv(IXAL_NUM_JOBS='{:d}'.format(max(1, nCPU // nWorkers)), IXAL_JOBSERVER=js.path):
+        while len(aReady) > 0 or len(mRunning) > 0:
+            while len(aReady) > 0 and len(mRunning) < nWorkers:
+                i = aReady.pop()
+                info = graph.aInfo[i]
+                logger.info("Start building {}".format(getUnitLabel(info)))
+                p = ctx.Process(target=buildUnit, args=(info['file'], info['cls']), name=info['cls'])
+                p.start()
+                mRunning[p.sentinel] = (i, p, time.time())
+
+            for sentinel in wait(list(mRunning)):
+                i, p, t0 = mRunning.pop(sentinel)
+                p.join()
+                label = getUnitLabel(graph.aInfo[i])
+                if p.exitcode != 0:
+                    logger.error("Failed to build {} (exit code {})".format(label, p.exitcode))
+                    sFailed.add(i)
+                    sSkipped |= graph.getDownstream(i)
+                    continue
+                logger.info("Finished building {} in {:.1f}s".format(label, time.time() - t0))
+                for j in graph.aRDeps[i]:
+                    aCount[j] -= 1
+                    if aCount[j] == 0 and j not in sSkipped:
+                        aReady.append(j)
+
+    for i in sorted(sSkipped - sFailed):
+        logger.error("Skipped {} because something it depends on failed".format(getUnitLabel(graph.aInfo[i])))
+    return [graph.aInfo[i] for i in sorted(sFailed | sSkipped)]
@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bz2
+import gzip
+import lzma
+import os
+import re
+import shutil
+import struct
+import threading
+import zlib
+from contextlib import contextmanager
+
+import Eikthyr as eik
+
+SIZE_CHUNK = 1 << 20
+
+# Wrap a binary file object, feeding everything read from it into some hash objects
+class HashingReader(object):
+    def __init__(self, fp, *aHash):
+        self.fp = fp
+        self.aHash = aHash
+        self.size = 0
+
+    def read(self, n=-1):
+        data = self.fp.read(n)
+        for h in self.aHash:
+            h.update(data)
+        self.size += len(data)
+        return data
+
+    # Read through whatever is left, so that the hashes cover the whole stream
+    def drain(self):
+        while self.read(SIZE_CHUNK):
+            pass
+
+# Also write everything read into another file object
+class TeeReader(HashingReader):
+    def __init__(self, fp, fpCopy, *aHash):
+        super().__init__(fp, *aHash)
+        self.fpCopy = fpCopy
+
+    def read(self, n=-1):
+        data = super().read(n)
+        self.fpCopy.write(data)
+        return data
+
+# Put back some bytes already read from the head of a binary file object
+class PrefixedReader(object):
+    def __init__(self, head, fp):
+        self.head = head
+        self.fp = fp
+
+    def read(self, n=-1):
+        if len(self.head) == 0:
+            return self.fp.read(n)
+        if n < 0:
+            data = self.head + self.fp.read()
+        else:
+            data = self.head[:n]
+        self.head = self.head[len(data):]
+        return data
+
+def pump(fpSrc, fpDst):
+    try:
+        shutil.copyfileobj(fpSrc, fpDst, SIZE_CHUNK)
+    except BrokenPipeError:
+        pass
+    finally:
+        fpDst.close()
+
+# Get a decompressed stream out of a binary file object, the format is decided by the magic bytes
+@contextmanager
+def openDecompressed(fp, name=''):
+    head = fp.read(6)
+    fp = PrefixedReader(head, fp)
+    if head.startswith(b'\x1f\x8b'):
+        with gzip.GzipFile(fileobj=fp, mode='rb') as fpDec:
+            yield fpDec
+    elif head.startswith(b'BZh'):
+        with bz2.BZ2File(fp, 'rb') as fpDec:
+            yield fpDec
+    elif head.startswith(b'\xfd7zXZ\x00') or (re.match(R'.*\.lzma$', str(name)) and head.startswith(b'\x5d\x00')):
+        with lzma.LZMAFile(fp, 'rb') as fpDec:
+            yield fpDec
+    elif head.startswith(b'\x28\xb5\x2f\xfd'):
+        # No zstd in the standard library, so let the zstd binary do the work while we feed it
+        p = eik.cmd.zstd.popen(('-dcq',), stderr=None)
+        thr = threading.Thread(target=pump, args=(fp, p.stdin), daemon=True)
+        thr.start()
+        try:
+            yield p.stdout
+            while p.stdout.read(SIZE_CHUNK):
+                pass
+        finally:
+            p.stdout.close()
+            thr.join()
+            rtn = p.wait()
+        if rtn != 0: # Only when the reader didn't fail by itself
+            raise RuntimeError("zstd failed to decompress {}".format(name))
+    else:
+        yield fp
+
+# Compress a file into <path>.gz and remove it, like 'gzip -n9' does: no name or time in the header, mode and times kept
+# zlib with memLevel 9 gives the same bytes as gzip itself for most small files, but not for all: deflate is implemented differently
+# The output is stable, just use gzip itself where the exact bytes matter
+def getGzipHeader(lvl=9):
+    return b'\x1f\x8b\x08\x00\x00\x00\x00\x00' + (b'\x02' if lvl == 9 else b'\x04' if lvl == 1 else b'\x00') + b'\x03'
+
+def gzipFile(path, lvl=9):
+    path = str(path)
+    pathOut = '{}.gz'.format(path)
+    st = os.stat(path)
+    comp = zlib.compressobj(lvl, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    crc = 0
+    size = 0
+    try:
+        with open(path, 'rb') as fp, open(pathOut, 'wb') as fpw:
+            fpw.write(getGzipHeader(lvl))
+            while True:
+                data = fp.read(SIZE_CHUNK)
+                if not data: break
+                crc = zlib.crc32(data, crc)
+                size += len(data)
+                fpw.write(comp.compress(data))
+            fpw.write(comp.flush())
+            fpw.write(struct.pack('<II', crc & 0xffffffff, size & 0xffffffff))
+            os.fchmod(fpw.fileno(), st.st_mode & 0o7777)
+    except BaseException:
+        os.unlink(pathOut)
+        raise
+    os.utime(pathOut, ns=(st.st_atime_ns, st.st_mtime_ns))
+    os.unlink(path)
+
+# The same as gzipFile, for something already in memory
+def gzipBytes(data, lvl=9):
+    comp = zlib.compressobj(lvl, zlib.DEFLATED, -zlib.MAX_WBITS, 9)
+    return getGzipHeader(lvl) + comp.compress(data) + comp.flush() + struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+
+# Rough single-thread zstd speed (MB/s) for some levels, used to fit a compression into a time budget
+SPEED_ZSTD = ((1, 500), (3, 350), (6, 120), (9, 80), (12, 40), (15, 20), (19, 6), (22, 3))
+
+# Pick the highest level (up to lvlMax) expected to compress this many bytes within the budget in seconds
+def pickZstdLevel(size, lvlMax=19, budget=0):
+    if budget <= 0:
+        return lvlMax
+    lvlRslt = 1
+    for (lvl, speed) in SPEED_ZSTD:
+        if lvl > lvlMax: break
+        if size / (speed * 1e6) <= budget:
+            lvlRslt = lvl
+    return lvlRslt
+
+# Compress everything written into the yielded stream into a zstd file
+@contextmanager
+def openZstdWriter(path, lvl=19, aArgs=()):
+    p = eik.cmd.zstd.popen(('-qfT0', '--ultra', '-{:d}'.format(lvl), *aArgs, '-o', str(path)), stdout=None, stderr=None)
+    try:
+        yield p.stdin
+    finally:
+        p.stdin.close()
+        rtn = p.wait()
+    if rtn != 0:
+        raise RuntimeError("zstd failed to compress {}".format(path))
+
+# Compress everything written into the yielded stream into a gzip file
+@contextmanager
+def openGzipWriter(path, lvl=9, aArgs=()):
+    with open(path, 'wb') as fpw:
+        p = eik.cmd.gzip.popen(('-nc', '-{:d}'.format(lvl), *aArgs), stdout=fpw, stderr=None)
+        try:
+            yield p.stdin
+        finally:
+            p.stdin.close()
+            rtn = p.wait()
+    if rtn != 0:
+        raise RuntimeError("gzip failed to compress {}".format(path))
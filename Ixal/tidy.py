@@ -17,10 +17,43 @@ import filecmp
 import os
 import re
 import shutil
+import struct
 import time
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import md5
+from inspect import getsource
 from pathlib import Path
 
 import Eikthyr as eik
+from plumbum import ProcessExecutionError
+
+from .index import getFileDigest
+from .stream import gzipFile
+
+# Yields (path relative to the top, os.DirEntry) for everything under path, parents before their children
+# A directory removed by whoever got its entry won't be descended into
+def walkTree(path, rel=''):
+    try:
+        with os.scandir(path) as it:
+            aEntry = sorted(it, key=lambda ent: ent.name)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    for ent in aEntry:
+        relThis = '{}/{}'.format(rel, ent.name) if rel else ent.name
+        yield (relThis, ent)
+        if ent.is_dir(follow_symlinks=False):
+            yield from walkTree(ent.path, relThis)
+
+# Walk the tree once, showing each entry to the visitors in order until one of them removes it
+def runVisitors(path, aVisitor):
+    for v in aVisitor:
+        v.begin()
+    if len(aVisitor) > 0:
+        for (rel, ent) in walkTree(path):
+            for v in aVisitor:
+                if v.visit(rel, ent): break
+    for v in aVisitor:
+        v.finish()
 
 class TaskPostProcessingBase(eik.StampTask):
     src = eik.TaskParameter()
@@ -30,9 +63,68 @@ class TaskPostProcessingBase(eik.StampTask):
     checkInputHash = True  # we DO actually care about the upstream status
     ReRunAfterDeps = True
 
-class TaskCanonicalize(TaskPostProcessingBase):
+    # If True: the work is done in begin(), visit() and finish(), so this can share one walk with others in TaskPostProcess
+    isVisitor = False
+
     def task(self):
         if not self.enabled: return
+        runVisitors(self.input().path, [self])
+
+    # The classes doing the work, all of their code counts instead of just task()
+    def getCodeClasses(self):
+        return (self.__class__,)
+
+    def getCodeHash(self):
+        if not self.checkCodeHash:
+            return '0'
+        aCls = [c for cls in self.getCodeClasses() for c in cls.__mro__ if issubclass(c, TaskPostProcessingBase)]
+        return md5('\0'.join(getsource(cls) for cls in aCls).encode('utf-8'), usedforsecurity=False).hexdigest()
+
+    # Before the walk
+    def begin(self):
+        pass
+
+    # Called for each entry, return True if the entry is removed
+    def visit(self, rel, ent):
+        return False
+
+    # After the walk
+    def finish(self):
+        pass
+
+class VisitorListParameter(eik.WhateverParameter):
+    def serializeShort(self, x):
+        return '+'.join(cls.__name__ for cls in x)
+
+# Run several visitor tasks in one walk
+class TaskPostProcess(TaskPostProcessingBase):
+    aTask = VisitorListParameter()
+
+    def getCodeClasses(self):
+        return (self.__class__, *self.aTask)
+
+    def task(self):
+        if not self.enabled: return
+        aVisitor = [cls(self.src, self.prefix, pathStamp=self.pathStamp) for cls in self.aTask]
+        self.logger.debug('Post-processing with {}'.format(', '.join(cls.__name__ for cls in self.aTask)))
+        runVisitors(self.input().path, [v for v in aVisitor if v.enabled])
+
+# Consecutive visitor classes are put into one list, to be run by one TaskPostProcess
+def fusePostProcess(aCls):
+    aRslt = []
+    for cls in aCls:
+        if not getattr(cls, 'isVisitor', False):
+            aRslt.append(cls)
+        elif len(aRslt) > 0 and isinstance(aRslt[-1], list):
+            aRslt[-1].append(cls)
+        else:
+            aRslt.append([cls])
+    return aRslt
+
+class TaskCanonicalize(TaskPostProcessingBase):
+    isVisitor = True
+
+    def begin(self):
         pathPrefix = Path(self.input().path) / Path(self.prefix).relative_to('/')
         if not pathPrefix.is_dir(): return # Nothing to see here
         with eik.chdir(pathPrefix):
@@ -57,16 +149,117 @@ class TaskCanonicalize(TaskPostProcessingBase):
                         p2.symlink_to(p1.name)
 
 
+# What kind of object strip would work on: 'elf', 'pe', 'ar', or None for anything else
+def getObjectType(head):
+    if head.startswith(b'\x7fELF'):
+        return 'elf'
+    if head.startswith(b'MZ'):
+        return 'pe'
+    if head.startswith(b'!<arch>\n'):
+        return 'ar'
+    return None
+
+# Whether an ELF file has any .debug* sections left, by reading its section headers
+def hasDebugELF(fp, head):
+    endian = '<' if head[5] == 1 else '>'
+    if head[4] == 2: # 64-bit
+        fp.seek(0x28)
+        (shoff,) = struct.unpack(endian + 'Q', fp.read(8))
+        fp.seek(0x3A)
+        fmtSection = endian + 'II16xQQ'
+    else:
+        fp.seek(0x20)
+        (shoff,) = struct.unpack(endian + 'I', fp.read(4))
+        fp.seek(0x2E)
+        fmtSection = endian + 'II8xII'
+    (shentsize, shnum, shstrndx) = struct.unpack(endian + 'HHH', fp.read(6))
+    if shoff == 0: return False
+    if shnum == 0: return True # Too many sections to be listed here, let strip figure it out
+    fp.seek(shoff)
+    data = fp.read(shentsize * shnum)
+    aSection = [struct.unpack_from(fmtSection, data, i * shentsize) for i in range(shnum)]
+    (_, _, offStr, sizeStr) = aSection[shstrndx]
+    fp.seek(offStr)
+    names = fp.read(sizeStr)
+    for (offName, _, _, _) in aSection:
+        name = names[offName:names.find(b'\0', offName)]
+        if name.startswith(b'.debug') or name.startswith(b'.zdebug'):
+            return True
+    return False
+
+# Whether a PE file has a COFF symbol table or debug sections (the long names of which start with '/')
+def hasDebugPE(fp):
+    fp.seek(0x3C)
+    (offPE,) = struct.unpack('<I', fp.read(4))
+    fp.seek(offPE)
+    if fp.read(4) != b'PE\0\0': return False
+    (nSection, nSymbol, sizeOpt) = struct.unpack('<2xH4x4xIH2x', fp.read(20))
+    if nSymbol > 0: return True
+    fp.seek(sizeOpt, 1)
+    for i in range(nSection):
+        name = fp.read(40)[:8]
+        if name.startswith(b'/') or name.startswith(b'.debug'):
+            return True
+    return False
+
 class TaskStrip(TaskPostProcessingBase):
-    def task(self):
-        if not self.enabled: return
-        for f in Path(self.input().path).glob('**/*'):
-            if f.is_dir(): continue
-            if f.stat().st_mode & 0o0100 or re.match('.*\.(a|so|dll|lib|exe)(\.[^/]*)?$', f.name):
+    isVisitor = True
+    reName = re.compile(R'.*\.(a|so|dll|lib|exe)(\.[^/]*)?$')
+
+    def begin(self):
+        self.aFile = []
+
+    def visit(self, rel, ent):
+        if not ent.is_file(follow_symlinks=False): return False
+        if self.reName.match(ent.name) or ent.stat(follow_symlinks=False).st_mode & 0o0100:
+            self.aFile.append(ent.path)
+        return False
+
+    # Returns (what happened, seconds spent in strip)
+    def stripFile(self, f):
+        try:
+            with open(f, 'rb') as fp:
+                head = fp.read(8)
+                typ = getObjectType(head)
+                if typ == None:
+                    return ('other', 0.0)
                 try:
-                    eik.cmd.strip('-pD', '-S', str(f))
-                except:
-                    continue
+                    if typ == 'elf' and not hasDebugELF(fp, head):
+                        return ('clean', 0.0)
+                    if typ == 'pe' and not hasDebugPE(fp):
+                        return ('clean', 0.0)
+                except (struct.error, IndexError, ValueError):
+                    pass # Something unusual, just give it to strip
+        except OSError:
+            return ('other', 0.0)
+
+        timeStart = time.time()
+        try:
+            eik.cmd.strip('-pD', '-S', f)
+        except ProcessExecutionError as e:
+            self.logger.warning('Failed to strip {}: {}'.format(f, e.stderr.strip()))
+            return ('failed', time.time() - timeStart)
+        return ('stripped', time.time() - timeStart)
+
+    def finish(self):
+        if len(self.aFile) == 0: return
+        njobs = int(eik.getenv('IXAL_NUM_JOBS', '3'))
+        timeStart = time.time()
+        mCount = {'stripped': 0, 'failed': 0, 'clean': 0, 'other': 0}
+        timeStrip = 0.0
+        with ThreadPoolExecutor(njobs) as executor:
+            for (rslt, t) in executor.map(self.stripFile, self.aFile):
+                mCount[rslt] += 1
+                timeStrip += t
+        timeWall = time.time() - timeStart
+
+        # Time saved: the strip runs avoided, plus whatever the parallel runs overlapped
+        nRun = mCount['stripped'] + mCount['failed']
+        timeSaved = max(0.0, timeStrip - timeWall)
+        if nRun > 0:
+            timeSaved += timeStrip / nRun * (mCount['clean'] + mCount['other'])
+        self.logger.info('Stripped {} of {} files with {} jobs in {:.2f}s, skipped {} without debug info and {} non-objects, {} failed, saved about {:.2f}s'.format(
+            mCount['stripped'], len(self.aFile), njobs, timeWall, mCount['clean'], mCount['other'], mCount['failed'], timeSaved))
 
 class TaskPurge(TaskPostProcessingBase):
     pattern = eik.ListParameter((
@@ -77,6 +270,8 @@ class TaskPurge(TaskPostProcessingBase):
         ), significant=False)
     patternExtra = eik.ListParameter((), significant=False)
 
+    isVisitor = True
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         aPatDir = []
@@ -89,20 +284,19 @@ class TaskPurge(TaskPostProcessingBase):
         self.reDir = re.compile('|'.join(aPatDir))
         self.reFile = re.compile('|'.join(aPatFile))
 
-    def task(self):
-        if not self.enabled: return
-        with eik.chdir(self.input().path):
-            for f in Path('.').glob('**/*'):
-                if not f.exists(): continue
-                if f.is_dir():
-                    if len(self.reDir.pattern) > 0 and self.reDir.match(str(f)):
-                        self.logger.debug("Purged folder: {}".format(str(f)))
-                        shutil.rmtree(f)
-                else:
-                    if f.name == '.INSTALL': continue # Try not to purge out the installation script
-                    if len(self.reFile.pattern) > 0 and self.reFile.match(str(f)):
-                        self.logger.debug("Purged file: {}".format(str(f)))
-                        f.unlink()
+    def visit(self, rel, ent):
+        if ent.is_dir(follow_symlinks=False):
+            if len(self.reDir.pattern) > 0 and self.reDir.match(rel):
+                self.logger.debug("Purged folder: {}".format(rel))
+                shutil.rmtree(ent.path)
+                return True
+        else:
+            if ent.name == '.INSTALL': return False # Try not to purge out the installation script
+            if len(self.reFile.pattern) > 0 and self.reFile.match(rel):
+                self.logger.debug("Purged file: {}".format(rel))
+                os.unlink(ent.path)
+                return True
+        return False
 
 class TaskPurgeLinux(TaskPurge):
     pattern = eik.ListParameter((
@@ -117,6 +311,12 @@ class TaskCompressMan(TaskPostProcessingBase):
     patternExtra = eik.ListParameter((), significant=False)
 
     patternMan = eik.Parameter('^.*\.[1-9]$', significant=False)
+    # If True: compress with zlib instead of running 'gzip -n9' over batches of pages
+    # No processes at all, but for some larger pages the bytes differ from what gzip gives, even though they decompress the same
+    inProcess = eik.BoolParameter(False, significant=False)
+    nBatchMax = 256 # Pages given to one gzip at most, to stay well within the command line length limit
+
+    isVisitor = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -127,17 +327,87 @@ class TaskCompressMan(TaskPostProcessingBase):
         self.reDir = re.compile('|'.join(aPatDir))
         self.reMan = re.compile(self.patternMan)
 
-    def task(self):
-        if not self.enabled: return
-        with eik.chdir(self.input().path):
-            for d in Path('.').glob('**/*'):
-                if not d.exists() and not d.is_dir(): continue
-                if not self.reDir.match(str(d)): continue
-                for f in d.iterdir():
-                    if f.is_dir() or not self.reMan.match(f.name): continue
-                    if f.is_symlink():
-                        tgt = f.readlink()
-                        f.unlink()
-                        Path('{}.gz'.format(str(f))).symlink_to('{}.gz'.format(str(tgt)))
-                        continue
-                    self.ex(eik.cmd.gzip['-n9', str(f)])
+    def begin(self):
+        self.aMan = []
+
+    def visit(self, rel, ent):
+        if ent.is_dir(): return False
+        if not self.reMan.match(ent.name): return False
+        if not self.reDir.match(os.path.dirname(rel)): return False
+        self.aMan.append(ent.path)
+        return False
+
+    # Compress after the walk, so that the walk doesn't see the new files
+    def finish(self):
+        aFile = []
+        for f in self.aMan:
+            if os.path.islink(f):
+                tgt = os.readlink(f)
+                os.unlink(f)
+                os.symlink('{}.gz'.format(tgt), '{}.gz'.format(f))
+            elif os.path.isfile(f):
+                aFile.append(f)
+        if len(aFile) == 0: return
+        nJobs = int(eik.getenv('IXAL_NUM_JOBS', '3'))
+        if self.inProcess:
+            func = gzipFile
+            aWork = aFile
+        else: # Each gzip gets a batch of pages, so that starting it costs little per page
+            func = lambda aBatch: eik.cmd.gzip('-n9', '--', *aBatch)
+            nBatch = min(self.nBatchMax, -(-len(aFile) // nJobs))
+            aWork = [aFile[i:i+nBatch] for i in range(0, len(aFile), nBatch)]
+        with ThreadPoolExecutor(nJobs) as executor:
+            for _ in executor.map(func, aWork):
+                pass
+        self.logger.info('Compressed {} man pages'.format(len(aFile)))
+
+# Turn files with identical content (and mode) into hardlinks to one of them
+# Not fused with the others: it has to see the files after they are stripped and compressed
+class TaskDedupe(TaskPostProcessingBase):
+    isSymlink = False
+
+    def begin(self):
+        self.mGroup = {} # (size, mode) -> [path relative to the top]
+        self.sInode = set()
+
+    def visit(self, rel, ent):
+        if not ent.is_file(follow_symlinks=False): return False
+        if '/' not in rel and rel.startswith('.'): return False # .INSTALL and the like
+        st = ent.stat(follow_symlinks=False)
+        if st.st_size == 0: return False
+        if st.st_nlink > 1: # Already a hardlink to something seen
+            if (st.st_dev, st.st_ino) in self.sInode: return False
+            self.sInode.add((st.st_dev, st.st_ino))
+        self.mGroup.setdefault((st.st_size, st.st_mode), []).append(rel)
+        return False
+
+    def replace(self, pathTop, relKeep, relDup):
+        pathDup = os.path.join(pathTop, relDup)
+        pathTmp = '{}.ixal-dedupe'.format(pathDup)
+        if self.isSymlink:
+            os.symlink(os.path.relpath(relKeep, os.path.dirname(relDup)), pathTmp)
+        else:
+            os.link(os.path.join(pathTop, relKeep), pathTmp)
+        os.replace(pathTmp, pathDup)
+
+    def finish(self):
+        pathTop = self.input().path
+        nFile = 0
+        sizeSaved = 0
+        for ((size, mode), aRel) in self.mGroup.items():
+            if len(aRel) < 2: continue
+            mDigest = {}
+            for rel in sorted(aRel):
+                mDigest.setdefault(getFileDigest(os.path.join(pathTop, rel)), []).append(rel)
+            for aSame in mDigest.values():
+                for rel in aSame[1:]:
+                    self.logger.debug('Deduplicated {} into {}'.format(rel, aSame[0]))
+                    self.replace(pathTop, aSame[0], rel)
+                    nFile += 1
+                    sizeSaved += size
+        if nFile > 0:
+            self.logger.info('Deduplicated {} files, saving {} bytes'.format(nFile, sizeSaved))
+
+# The same, but with relative symlinks, for when hardlinks aren't welcome
+class TaskDedupeSymlink(TaskDedupe):
+    isSymlink = True
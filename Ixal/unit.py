@@ -15,22 +15,28 @@
 
 import re
 import inspect
+import json
+import os
 from copy import deepcopy
+from hashlib import sha256
 from pathlib import Path
 
 import Eikthyr as eik
 import luigi as lg
 from plumbum import FG
 
+from .artifact import openArtifactStore
 from .build import TaskRunScript, TaskRunPackageScript
+from .cas import ObjectStore
 from .cmd import MixinBuildUtilities
-from .download import TaskDownload, TaskDownloadYoutube
-from .extract import TaskExtractTar, TaskExtract7z, TaskExtract7zOptional, TaskExtractMSI
+from .download import TaskDownload, TaskDownloadYoutube, fetchAll
+from .extract import TaskExtractTar, TaskStreamExtractTar, TaskExtract7z, TaskExtract7zOptional, TaskExtractMSI
+from .index import getFileDigest
 from .logging import logger
-from .pack import TaskPackageInfo, TaskPackageMTree, TaskPackageTar
+from .pack import TaskPackage, mProfileZstd
 from .task import pickTask
 from .preproc import TaskHostPath
-from .tidy import TaskCanonicalize, TaskStrip, TaskPurge, TaskPurgeLinux, TaskCompressMan
+from .tidy import TaskCanonicalize, TaskStrip, TaskPurge, TaskPurgeLinux, TaskCompressMan, TaskDedupe, TaskDedupeSymlink, TaskPostProcess, fusePostProcess
 from .ver import getVersionString
 
 
@@ -43,6 +49,8 @@ class UnitConfig(lg.Config):
     isRepackage = eik.BoolParameter(False) # If True: don't do too many post-processing
     isHostInPrefix = eik.BoolParameter(False) # If True: assume the toolchain is hosted inside prefix, do some pre-processing to change hard-coded paths
     allowLTO = eik.BoolParameter(True) # If False: filter out -flto flags
+    compression = eik.Parameter('default') # Compression profile of the packages: fast, default or max
+    artifactStore = eik.Parameter('') # A directory or an http(s) url sharing finished packages between machines, empty: don't share
 
 class Unit(MixinBuildUtilities):
     name = ''
@@ -54,7 +62,7 @@ class Unit(MixinBuildUtilities):
     rel = '1'
     arch = 'any'
     url = ''
-    packager = UnitConfig().packager
+    packager = None # None: take the value from UnitConfig
     replaces = ()
     groups = ()
     depends = ()
@@ -70,21 +78,48 @@ class Unit(MixinBuildUtilities):
             ('.*\.exe$', TaskExtract7zOptional),
             ]
 
-    isRepackage = UnitConfig().isRepackage
-    isHostInPrefix = UnitConfig().isHostInPrefix
-    allowLTO = UnitConfig().allowLTO
+    isRepackage = None
+    isHostInPrefix = None
+    allowLTO = None
+    compression = None
+    artifactStore = None
     aTaskPostProcess = []
     aTaskPreProcess = []
+    dedupe = None # 'hardlink' or 'symlink': replace files having the same content inside the package
+    streamSource = False # If True: extract tar sources while downloading them, unless 'stream' in the src entry says otherwise
 
     extension = 'pkg.tar.zst'
     environ = {}
     logger = logger
 
     def __init__(self):
+        config = UnitConfig()
+        if self.packager == None:
+            self.packager = config.packager
+        if self.isRepackage == None:
+            self.isRepackage = config.isRepackage
+        if self.isHostInPrefix == None:
+            self.isHostInPrefix = config.isHostInPrefix
+        if self.allowLTO == None:
+            self.allowLTO = config.allowLTO
+        if self.compression == None:
+            self.compression = config.compression
+        if self.artifactStore == None:
+            self.artifactStore = config.artifactStore
+        if self.compression not in mProfileZstd:
+            raise ValueError("Unknown compression profile {}".format(self.compression))
+
+        aTaskDedupe = []
+        if self.dedupe == 'hardlink':
+            aTaskDedupe = [TaskDedupe]
+        elif self.dedupe == 'symlink':
+            aTaskDedupe = [TaskDedupeSymlink]
+        elif self.dedupe:
+            raise ValueError("Unknown dedupe mode {}".format(self.dedupe))
         if not self.isRepackage:
-            self.aTaskPostProcess = [TaskCanonicalize, TaskPurge, TaskPurgeLinux, TaskCompressMan, TaskStrip] + self.aTaskPostProcess
+            self.aTaskPostProcess = [TaskCanonicalize, TaskPurge, TaskPurgeLinux, TaskCompressMan, TaskStrip] + aTaskDedupe + self.aTaskPostProcess
         else:
-            self.aTaskPostProcess = [TaskPurge] + self.aTaskPostProcess
+            self.aTaskPostProcess = [TaskPurge] + aTaskDedupe + self.aTaskPostProcess
         if self.isHostInPrefix:
             self.aTaskPreProcess = [TaskHostPath] + self.aTaskPreProcess
         if isinstance(self.name, str):
@@ -92,10 +127,10 @@ class Unit(MixinBuildUtilities):
         else:
             self.base = self.name[0]
         self.fullver = self.getFullVersion()
-        self.pathCache = Path(UnitConfig().pathCache).resolve()
-        self.pathBuild = Path(UnitConfig().pathBuild).resolve() / 'src-{}-{}'.format(self.base, self.fullver)
-        self.pathOutput = Path(UnitConfig().pathOutput).resolve()
-        self.pathPrefix = Path(UnitConfig().pathPrefix).resolve()
+        self.pathCache = Path(config.pathCache).resolve()
+        self.pathBuild = Path(config.pathBuild).resolve() / 'src-{}-{}'.format(self.base, self.fullver)
+        self.pathOutput = Path(config.pathOutput).resolve()
+        self.pathPrefix = Path(config.pathPrefix).resolve()
         self.pathPrefixRel = self.pathPrefix.relative_to('/')
         self.doSanityCheck()
 
@@ -139,8 +174,151 @@ class Unit(MixinBuildUtilities):
                 self.depends.append(val)
         return self
 
+    # One download task for each entry in src
+    def getDownloadTasks(self):
+        urls = self.src
+        if isinstance(urls, str) or isinstance(urls, dict):
+            urls = (urls,)
+        aTask = []
+        for f in urls:
+            if isinstance(f, str):
+                f = {'url': f}
+            aTask.append(pickTask(self.mTaskDownload, f['url'])(f['url'], self.pathCache, filename=f.get('filename', ''), sha256=f.get('sha256', '')))
+        return aTask
+
+    # Arguments for the extract task of a src/lsrc entry
+    def getExtractArgs(self, f):
+        mArgs = dict(f.get('extractArgs', {}))
+        for key in ('include', 'exclude'):
+            if key in f:
+                aPattern = f[key]
+                if isinstance(aPattern, str):
+                    aPattern = (aPattern,)
+                mArgs[key] = tuple(aPattern)
+        return mArgs
+
+    # Download all the sources in parallel without building anything
+    def fetch(self, nthreads=8, nPerHost=2):
+        return fetchAll(self.getDownloadTasks(), nthreads=nthreads, nPerHost=nPerHost)
+
+    def getPackageNames(self):
+        if isinstance(self.name, str): # Single package mode
+            return (self.name,)
+        return tuple(self.name)
+
+    def getPackageFileName(self, name):
+        return '{}-{}-{}.{}'.format(name, self.fullver, self.arch, self.extension)
+
+    # Everything the packages are built from: the recipe, the sources, the environment, and where and for what they go
+    # Downloaded sources count by their declared sha256, or else by the digest of what we actually got
+    # Sources without either are fetched first, None if that fails
+    def getArtifactKey(self):
+        aKey = [inspect.getsource(cls) for cls in self.__class__.__mro__ if issubclass(cls, Unit) and cls is not Unit]
+        store = ObjectStore(self.pathCache)
+        aSrc = self.src
+        if isinstance(aSrc, str) or isinstance(aSrc, dict):
+            aSrc = (aSrc,)
+        aTaskDownload = self.getDownloadTasks()
+        getDigest = lambda t: t.sha256.lower() or t.getStoredDigest(store)
+        aMissing = [t for t in aTaskDownload if not getDigest(t)]
+        if len(aMissing) > 0:
+            fetchAll(aMissing)
+        for (f, tDl) in zip(aSrc, aTaskDownload):
+            if isinstance(f, str):
+                f = {'url': f}
+            digest = getDigest(tDl)
+            if not digest:
+                return None
+            aKey.append([f, digest])
+        aLocal = self.lsrc
+        if isinstance(aLocal, str) or isinstance(aLocal, dict):
+            aLocal = (aLocal,)
+        for f in aLocal:
+            if isinstance(f, str):
+                f = {'url': f}
+            fThis = Path(inspect.getfile(self.__class__)).parent / f['url']
+            if fThis.is_dir():
+                aKey.append([f, [(str(p.relative_to(fThis)), getFileDigest(p)) for p in sorted(fThis.glob('**/*')) if p.is_file()]])
+            else:
+                aKey.append([f, getFileDigest(fThis)])
+        aKey.append(sorted(self.environ.items()))
+        aKey += [str(self.pathPrefix), self.arch, self.getPackageNames(), self.fullver, self.extension, self.compression, self.allowLTO]
+        return sha256(json.dumps(aKey, default=str).encode('utf-8')).hexdigest()
+
+    # The key of the local packages, as last built or fetched
+    def getPathArtifactKey(self):
+        return self.pathOutput / '{}-{}-{}.artifact'.format(self.base, self.fullver, self.arch)
+
+    # Take the packages from the artifact store if they aren't here yet, returns True if they are good to go without building
+    # Every file is checked against the size and sha256 listed in the index put there along with them
+    def fetchArtifacts(self, store, key):
+        aFile = [self.getPackageFileName(name) for name in self.getPackageNames()]
+        if all((self.pathOutput / f).exists() for f in aFile):
+            try:
+                return self.getPathArtifactKey().read_text() == key
+            except FileNotFoundError:
+                return False # Let the tasks decide whether these are still good
+        self.pathOutput.mkdir(parents=True, exist_ok=True)
+        pathIndex = self.getPathArtifactKey().with_suffix('.artifact-index')
+        mPart = {f: self.pathOutput / '{}.artifact-part'.format(f) for f in aFile}
+        try:
+            if not store.get(key, 'index.json', pathIndex):
+                return False
+            mIndex = json.loads(pathIndex.read_text())
+            for f in aFile:
+                if f not in mIndex or not store.get(key, f, mPart[f]):
+                    return False
+                if [mPart[f].stat().st_size, getFileDigest(mPart[f])] != mIndex[f]:
+                    self.logger.warning('{} from the artifact store is corrupted, building it instead'.format(f))
+                    return False
+            for f in aFile:
+                os.replace(mPart[f], self.pathOutput / f)
+        except Exception as e:
+            self.logger.warning('Failed to look up {} in the artifact store: {}'.format(self.base, e))
+            return False
+        finally:
+            pathIndex.unlink(missing_ok=True)
+            for pathPart in mPart.values():
+                pathPart.unlink(missing_ok=True)
+        self.getPathArtifactKey().write_text(key)
+        self.logger.info('Got {} from the artifact store'.format(', '.join(aFile)))
+        return True
+
+    # The packages go first, then the index listing them, so that a half-done upload is never used
+    def putArtifacts(self, store, key):
+        mIndex = {}
+        for name in self.getPackageNames():
+            f = self.getPackageFileName(name)
+            mIndex[f] = [(self.pathOutput / f).stat().st_size, getFileDigest(self.pathOutput / f)]
+            try:
+                store.put(key, f, self.pathOutput / f)
+            except Exception as e:
+                self.logger.warning('Failed to put {} into the artifact store: {}'.format(f, e))
+                return
+        pathIndex = self.getPathArtifactKey().with_suffix('.artifact-index')
+        pathIndex.write_text(json.dumps(mIndex, sort_keys=True))
+        try:
+            store.put(key, 'index.json', pathIndex)
+        except Exception as e:
+            self.logger.warning('Failed to put the index of {} into the artifact store: {}'.format(self.base, e))
+            return
+        finally:
+            pathIndex.unlink()
+        self.getPathArtifactKey().write_text(key)
+
     def make(self):
+        store = None
+        if self.artifactStore:
+            store = openArtifactStore(self.artifactStore)
+            unitKey = deepcopy(self) # src and lsrc below get replaced by the extracted paths
+            key = self.getArtifactKey()
+            if key == None:
+                self.logger.info('Failed to fetch the sources of {}, not looking in the artifact store'.format(self.base))
+            elif self.fetchArtifacts(store, key):
+                return
+
         urls = self.src
+        aTaskDownload = self.getDownloadTasks()
         self.src = []
         if isinstance(urls, str) or isinstance(urls, dict):
             urls = (urls,)
@@ -150,22 +328,25 @@ class Unit(MixinBuildUtilities):
             lfiles = (lfiles,)
 
         aTaskSource = []
-        for (i,f) in enumerate(urls):
+        for (i,(f,tDl)) in enumerate(zip(urls, aTaskDownload)):
             if isinstance(f, str):
                 f = {'url': f}
-            tDl = pickTask(self.mTaskDownload, f['url'])(f['url'], self.pathCache, filename=f.get('filename', ''))
+            f = dict(f) # Don't write into the recipe's own entry
             if 'extract' not in f:
                 f['extract'] = pickTask(self.mTaskExtract, tDl.output().path)
+            if f['extract'] == TaskExtractTar and f.get('stream', self.streamSource):
+                f['extract'] = TaskStreamExtractTar
             if f['extract'] == None:
                 aTaskSource.append(tDl)
                 self.src.append(tDl.output().path)
             else:
-                tEx = f['extract'](tDl, self.pathBuild / '{:d}'.format(i), canChange=True, **f.get('extractArgs', {}))
+                tEx = f['extract'](tDl, self.pathBuild / '{:d}'.format(i), canChange=True, pathCache=str(self.pathCache), **self.getExtractArgs(f))
                 aTaskSource.append(tEx)
                 self.src.append(tEx.output().path)
         for (i,f) in enumerate(lfiles):
             if isinstance(f, str):
                 f = {'url': f}
+            f = dict(f)
             fThis = Path(inspect.getfile(self.__class__)).parent / f['url']
             if 'extract' not in f:
                 f['extract'] = pickTask(self.mTaskExtract, fThis)
@@ -173,7 +354,7 @@ class Unit(MixinBuildUtilities):
                 aTaskSource.append(eik.InputTask(fThis, canChange=True))
                 self.lsrc.append(fThis)
             else:
-                tEx = f['extract'](eik.InputTask(fThis, canChange=True), self.pathBuild / 'L{:d}'.format(i), canChange=True, **f.get('extractArgs', {}))
+                tEx = f['extract'](eik.InputTask(fThis, canChange=True), self.pathBuild / 'L{:d}'.format(i), canChange=True, pathCache=str(self.pathCache), **self.getExtractArgs(f))
                 aTaskSource.append(tEx)
                 self.lsrc.append(tEx.output().path)
 
@@ -183,31 +364,30 @@ class Unit(MixinBuildUtilities):
                 taskThis = cls(tSrc, pathStamp=self.pathBuild, prefix=str(self.pathPrefix), prev=aTaskPre)
                 aTaskPre.append(taskThis)
         tPre = TaskRunScript(aTaskSource, self, 'prepare', pathStamp=self.pathBuild, prev=aTaskPre)
-        tBuild = TaskRunScript(aTaskSource, self, 'build', pathStamp=self.pathBuild, prev=(tPre,))
+        tBuild = TaskRunScript((), self, 'build', pathStamp=self.pathBuild, prev=(tPre,))
 
         aTaskFinal = []
-        aNames = self.name
-        if isinstance(aNames, str): # Single package mode
-            aNames = (aNames,)
+        aNames = self.getPackageNames()
         for (i,name) in enumerate(aNames):
             unitThis = deepcopy(self)
             unitThis.name = name
             pathPkg = Path(UnitConfig().pathBuild).resolve() / 'pkg-{}-{}'.format(name, self.fullver)
             if len(aNames) == 1:
-                tPkg = TaskRunPackageScript(aTaskSource, unitThis, 'package', pathPkg, prev=(tBuild,))
+                tPkg = TaskRunPackageScript((), unitThis, 'package', pathPkg, prev=(tBuild,))
             else:
-                tPkg = TaskRunPackageScript(aTaskSource, unitThis, 'package{:d}'.format(i), pathPkg, prev=(tBuild,))
+                tPkg = TaskRunPackageScript((), unitThis, 'package{:d}'.format(i), pathPkg, prev=(tBuild,))
 
-            # Cleanup/Tidying installed package
+            # Cleanup/Tidying installed package, consecutive visitors share one walk over the tree
             aTaskPost = []
-            for cls in self.aTaskPostProcess:
-                taskThis = cls(tPkg, pathStamp=self.pathBuild, prefix=str(self.pathPrefix), prev=aTaskPost)
+            for cls in fusePostProcess(self.aTaskPostProcess):
+                if isinstance(cls, list):
+                    taskThis = TaskPostProcess(tPkg, pathStamp=self.pathBuild, prefix=str(self.pathPrefix), aTask=tuple(cls), prev=aTaskPost)
+                else:
+                    taskThis = cls(tPkg, pathStamp=self.pathBuild, prefix=str(self.pathPrefix), prev=aTaskPost)
                 aTaskPost.append(taskThis)
 
             # Final touch and tarring things up
-            tInfo = TaskPackageInfo(tPkg, unitThis, prev=aTaskPost)
-            tMTree = TaskPackageMTree(tInfo)
-            tPack = TaskPackageTar(tMTree, self.pathOutput / '{}-{}-{}.{}'.format(name, self.fullver, self.arch, self.extension))
+            tPack = TaskPackage(tPkg, unitThis, self.pathOutput / self.getPackageFileName(name), self.compression, pathStats=Path(UnitConfig().pathBuild).resolve() / 'pkgstats.jsonl', prev=aTaskPost)
             aTaskFinal.append(tPack)
 
         # Filter out LTO things here
@@ -218,6 +398,10 @@ class Unit(MixinBuildUtilities):
 
         with eik.withEnv(**self.environ):
             eik.run(aTaskFinal)
+        if store != None:
+            key = unitKey.getArtifactKey()
+            if key != None:
+                self.putArtifacts(store, key)
 
     def prepare(self):
         pass
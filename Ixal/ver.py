@@ -13,6 +13,9 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+from functools import lru_cache, total_ordering
+
 import rpm_vercmp
 
 def getVersionString(ver, rel, epoch=0, filename=True):
@@ -62,3 +65,82 @@ def vercmp(src1, src2):
         ret = rpm_vercmp.vercmp(rel1, rel2)
 
     return ret
+
+# rpm-style version segments turned into a tuple that python compares the same way as rpm_vercmp:
+# tilde < end of string < alphabetic < numeric
+RE_SEGMENT = re.compile(R'~|[0-9]+|[a-zA-Z]+')
+SEG_END = (1,)
+
+def getSegmentKey(src):
+    aKey = []
+    for seg in RE_SEGMENT.findall(src):
+        if seg == '~':
+            aKey.append((0,))
+        elif seg[0].isdigit():
+            aKey.append((3, int(seg)))
+        else:
+            aKey.append((2, seg))
+    aKey.append(SEG_END)
+    return tuple(aKey)
+
+def cmpKey(a, b):
+    return (a > b) - (a < b)
+
+# A parsed version string, ordered the same way as vercmp
+@total_ordering
+class VersionKey(object):
+    __slots__ = ('src', 'epoch', 'ver', 'rel')
+
+    def __init__(self, src):
+        self.src = src
+        if src == '' or src == None:
+            self.epoch = self.ver = self.rel = None
+            return
+        ver, rel, epoch = parseVersionString(src)
+        self.epoch = getSegmentKey(epoch)
+        self.ver = getSegmentKey(ver)
+        self.rel = getSegmentKey(rel) if rel != '' else None
+
+    def __repr__(self):
+        return 'VersionKey({!r})'.format(self.src)
+
+    # Return 0 if equal, 1 if self is newer, -1 if other is newer
+    def compare(self, other):
+        if self.ver == None:
+            return 0 if other.ver == None else -1
+        if other.ver == None:
+            return 1
+        if self.src == other.src:
+            return 0
+        ret = cmpKey(self.epoch, other.epoch)
+        if ret == 0:
+            ret = cmpKey(self.ver, other.ver)
+        if ret == 0 and self.rel != None and other.rel != None:
+            ret = cmpKey(self.rel, other.rel)
+        return ret
+
+    def __eq__(self, other):
+        return self.compare(other) == 0
+
+    def __lt__(self, other):
+        return self.compare(other) < 0
+
+    # Release is ignored when only one side has it, so it can't be part of the hash
+    def __hash__(self):
+        return hash((self.epoch, self.ver))
+
+@lru_cache(maxsize=65536)
+def getVersionKey(src):
+    return VersionKey(src)
+
+# Sort version strings (or things having them, through key) from oldest to newest
+def sortVersions(aItem, key=None, reverse=False):
+    if key == None:
+        return sorted(aItem, key=getVersionKey, reverse=reverse)
+    return sorted(aItem, key=lambda x: getVersionKey(key(x)), reverse=reverse)
+
+# The newest version string (or thing having it, through key)
+def newest(aItem, key=None):
+    if key == None:
+        return max(aItem, key=getVersionKey)
+    return max(aItem, key=lambda x: getVersionKey(key(x)))
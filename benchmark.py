@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from functools import cmp_to_key
+from pathlib import Path
+
+def makeVersions(n, seed=0):
+    rnd = random.Random(seed)
+    aVer = []
+    for i in range(n):
+        ver = '.'.join(str(rnd.randint(0, 30)) for j in range(rnd.randint(1, 4)))
+        if rnd.random() < 0.2:
+            ver += rnd.choice(('a', 'b', 'rc', 'pre', '~beta')) + str(rnd.randint(0, 5))
+        if rnd.random() < 0.1:
+            ver = '{}:{}'.format(rnd.randint(1, 3), ver)
+        aVer.append('{}-{}'.format(ver, rnd.randint(1, 9)))
+    return aVer
+
+def timeIt(func, repeat=3):
+    tBest = None
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        t = time.perf_counter() - t0
+        if tBest == None or t < tBest:
+            tBest = t
+    return tBest
+
+# Sorting with the old comparator versus the precomputed version keys
+def benchVersionSort(n=20000):
+    from Ixal.ver import vercmp, getVersionKey, sortVersions
+    aVer = makeVersions(n)
+    tCmp = timeIt(lambda: sorted(aVer, key=cmp_to_key(vercmp)))
+    getVersionKey.cache_clear()
+    tKeyCold = timeIt(lambda: (getVersionKey.cache_clear(), sortVersions(aVer)))
+    tKeyWarm = timeIt(lambda: sortVersions(aVer))
+    print('Sorting {:d} versions:'.format(n))
+    print('  cmp_to_key(vercmp): {:8.3f}s'.format(tCmp))
+    print('  sortVersions, cold: {:8.3f}s ({:.1f}x)'.format(tKeyCold, tCmp / tKeyCold))
+    print('  sortVersions, warm: {:8.3f}s ({:.1f}x)'.format(tKeyWarm, tCmp / tKeyWarm))
+
+# Run "python -X importtime -m Ixal ..." and return (wall time, {top-level module: cumulative import time})
+def runImportTime(aArgs, cwd):
+    env = dict(os.environ, PYTHONPATH=str(Path(__file__).resolve().parent))
+    t0 = time.perf_counter()
+    p = subprocess.run((sys.executable, '-X', 'importtime', '-m', 'Ixal', *aArgs), cwd=cwd, env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, encoding='utf-8')
+    t = time.perf_counter() - t0
+    mImport = {}
+    for line in p.stderr.splitlines():
+        if not line.startswith('import time:'): continue
+        aField = line[12:].split('|')
+        if len(aField) != 3 or not aField[1].strip().isdigit(): continue
+        if aField[2].startswith('  '): continue # Only the top-level ones
+        mImport[aField[2].strip()] = int(aField[1]) / 1e6
+    return (t, mImport)
+
+# Cold-start latency of each subcommand, doing as little real work as possible
+def benchStartup(repeat=3):
+    with tempfile.TemporaryDirectory() as d:
+        with tarfile.open(Path(d) / 'empty.files', 'w'):
+            pass
+        (Path(d) / 'recipes').mkdir()
+        mCmd = {
+                'usage': (),
+                'add': ('add', 'out.files', 'empty.files'),
+                'build': ('build', 'recipes'),
+                'latest': ('latest', 'recipes'),
+                'rebuild': ('rebuild',),
+                }
+        print('Startup of each subcommand (best of {:d}):'.format(repeat))
+        for (name, aArgs) in mCmd.items():
+            aRslt = [runImportTime(aArgs, d) for i in range(repeat)]
+            t, mImport = min(aRslt, key=lambda x: x[0])
+            aTop = sorted(mImport.items(), key=lambda x: -x[1])[:3]
+            print('  {:8s} wall {:6.3f}s, imports {:6.3f}s: {}'.format(name, t, sum(mImport.values()),
+                ', '.join('{} {:.3f}s'.format(m, tm) for (m, tm) in aTop)))
+
+mBench = {
+        'ver': benchVersionSort,
+        'startup': benchStartup,
+        }
+
+if __name__ == '__main__':
+    aName = sys.argv[1:]
+    if len(aName) == 0:
+        aName = list(mBench.keys())
+    for name in aName:
+        mBench[name]()
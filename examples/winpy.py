@@ -12,13 +12,10 @@ class WinPy(Unit):
     rel = '1'
     desc = "Native Windows Python"
     arch = 'x86_64'
-    src = "https://sourceforge.net/projects/winpython/files/WinPython_{0}/{1}/Winpython64-{1}dot.exe/download".format(_subver, ver)
-
-    def build(self):
-        dirSrc = next(Path(self.src[0]).glob('python-*.amd64'))
-        with eik.chdir(dirSrc):
-            shutil.rmtree('Doc', ignore_errors=True)
-            shutil.rmtree('tcl', ignore_errors=True)
+    src = {
+            'url': "https://sourceforge.net/projects/winpython/files/WinPython_{0}/{1}/Winpython64-{1}dot.exe/download".format(_subver, ver),
+            'exclude': ('python-*.amd64/Doc', 'python-*.amd64/tcl'),
+            }
 
     def package(self):
         dirDest = Path('winpy')
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+from pathlib import Path
+
+import pytest
+
+pathRepo = Path(__file__).resolve().parent.parent
+
+# An in-tree make build: it writes into the extracted source tree, and package() takes its output from there
+textRecipe = '''
+from pathlib import Path
+import Ixal
+def log(s):
+    with open(Path(__file__).parent / 'log', 'a') as fp: fp.write(s + '\\n')
+class Foo(Ixal.Unit):
+    name = 'foo'
+    lsrc = 'src.tar.gz'
+    def build(self):
+        log('build')
+        self.runMake()
+    def package(self):
+        log('package {}')
+        Path('opt').mkdir()
+        Path('opt/out.txt').write_text((self.pathBuild / 'L0' / 'out.txt').read_text())
+'''
+
+textRun = '''
+import sys
+from Ixal.catalog import loadRecipe
+loadRecipe(sys.argv[1], '__ixal_recipe__').Foo().make()
+'''
+
+def runRecipe(path, version):
+    (path / 'recipe.py').write_text(textRecipe.format(version))
+    env = dict(os.environ, PYTHONPATH=str(pathRepo))
+    subprocess.run((sys.executable, 'run.py', 'recipe.py'), cwd=path, env=env, check=True, capture_output=True)
+    return (path / 'log').read_text().split()
+
+@pytest.mark.skipif(shutil.which('make') == None, reason='needs make')
+def test_edit_package_only(tmp_path):
+    (tmp_path / 'Makefile').write_text('all:\n\techo built > out.txt\n')
+    with tarfile.open(tmp_path / 'src.tar.gz', 'w:gz') as tar:
+        tar.add(tmp_path / 'Makefile', 'Makefile')
+    (tmp_path / 'run.py').write_text(textRun)
+
+    assert runRecipe(tmp_path, 'v1') == ['build', 'package', 'v1']
+    # Only package() changed: the built tree must be left alone, and build must not run again
+    aLog = runRecipe(tmp_path, 'v2')
+    assert aLog == ['build', 'package', 'v1', 'package', 'v2']
+    assert (tmp_path / '.build' / 'src-foo-1.0-1' / 'L0' / 'out.txt').exists()
+    assert runRecipe(tmp_path, 'v2') == aLog
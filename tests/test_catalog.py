@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+import pytest
+
+from Ixal.catalog import NeedImport, RecipeCatalog, scanRecipeAST
+
+textPlain = '''
+import Ixal
+class Foo(Ixal.Unit):
+    name = 'foo'
+    ver = '2.0'
+'''
+
+# Needs an import to know the name, and the import fails until helper.py appears
+textImport = '''
+import Ixal
+from helper import NAME
+class Bar(Ixal.Unit):
+    name = NAME
+'''
+
+def test_cache(tmp_path, monkeypatch):
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / 'foo.py').write_text(textPlain)
+    (tmp_path / 'bar.py').write_text(textImport)
+    pathCache = tmp_path / 'catalog.json'
+
+    aInfo = RecipeCatalog(pathCache).scan(tmp_path / 'foo.py') + RecipeCatalog(pathCache).scan(tmp_path / 'bar.py')
+    assert [(info['cls'], info['name'], info['ver']) for info in aInfo] == [('Foo', 'foo', '2.0')]
+    # Neither the failure nor the imported result is kept, only what was read from the syntax tree
+    assert list(json.loads(pathCache.read_text())) == [str((tmp_path / 'foo.py').resolve())]
+
+    (tmp_path / 'helper.py').write_text("NAME = 'bar'\n")
+    aInfo = RecipeCatalog(pathCache).scan(tmp_path / 'bar.py')
+    assert [(info['cls'], info['name']) for info in aInfo] == [('Bar', 'bar')]
+    assert list(json.loads(pathCache.read_text())) == [str((tmp_path / 'foo.py').resolve())]
+
+textAnnotated = '''
+import Ixal
+class Foo(Ixal.Unit):
+    name: str = 'foo'
+    ver = rel = '2'
+    depends: tuple
+'''
+
+def test_ast_annotated():
+    aInfo = scanRecipeAST(textAnnotated)
+    assert [(info['name'], info['ver'], info['rel'], info['depends']) for info in aInfo] == [('foo', '2', '2', ())]
+
+# Anything not understood about the attributes needs the real import
+@pytest.mark.parametrize('stmt', ("name: str = getName()", "name, ver = 'foo', '2'", "depends += ('bar',)"))
+def test_ast_need_import(stmt):
+    with pytest.raises(NeedImport):
+        scanRecipeAST('import Ixal\nclass Foo(Ixal.Unit):\n    {}\n'.format(stmt))
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import gzip
+import io
+import tarfile
+
+import Eikthyr as eik
+import pytest
+
+from Ixal import extract
+from Ixal.extract import TaskExtractTar, extractTarStream
+
+# A tar in memory from (name, type, content or link target)
+def makeTar(aMember):
+    fp = io.BytesIO()
+    with tarfile.open(fileobj=fp, mode='w') as tar:
+        for (name, kind, data) in aMember:
+            info = tarfile.TarInfo(name)
+            info.type = kind
+            info.mode = 0o755 if kind == tarfile.DIRTYPE else 0o644
+            if kind in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+                info.linkname = data
+                tar.addfile(info)
+            elif kind == tarfile.REGTYPE:
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+            else:
+                tar.addfile(info)
+    fp.seek(0)
+    return fp
+
+@pytest.fixture
+def dirs(tmp_path):
+    (tmp_path / 'dest').mkdir()
+    (tmp_path / 'outside').mkdir()
+    return (tmp_path / 'dest', tmp_path / 'outside')
+
+def test_plain(dirs):
+    dest, _ = dirs
+    fp = makeTar([('top/a', tarfile.DIRTYPE, None), ('top/a/f', tarfile.REGTYPE, b'x'), ('top/l', tarfile.SYMTYPE, 'a/f'), ('top/h', tarfile.LNKTYPE, 'top/a/f')])
+    assert extractTarStream(fp, dest) == 1
+    assert (dest / 'a' / 'f').read_bytes() == b'x'
+    assert (dest / 'l').resolve() == (dest / 'a' / 'f').resolve()
+    assert (dest / 'h').stat().st_ino == (dest / 'a' / 'f').stat().st_ino
+
+def test_file_through_symlink(dirs):
+    dest, outside = dirs
+    fp = makeTar([('a', tarfile.SYMTYPE, str(outside)), ('a/evil', tarfile.REGTYPE, b'x')])
+    with pytest.raises(tarfile.ExtractError):
+        extractTarStream(fp, dest)
+    assert not (outside / 'evil').exists()
+
+def test_dir_through_symlink(dirs):
+    dest, outside = dirs
+    fp = makeTar([('a', tarfile.SYMTYPE, str(outside)), ('a/sub', tarfile.DIRTYPE, None), ('a', tarfile.DIRTYPE, None)])
+    with pytest.raises(tarfile.ExtractError):
+        extractTarStream(fp, dest)
+    assert not (outside / 'sub').exists()
+
+def test_hardlink_to_symlink(dirs):
+    dest, outside = dirs
+    (outside / 'secret').write_bytes(b's')
+    fp = makeTar([('l', tarfile.SYMTYPE, str(outside / 'secret')), ('h', tarfile.LNKTYPE, 'l')])
+    extractTarStream(fp, dest)
+    assert (dest / 'h').is_symlink()
+    assert (dest / 'h').lstat().st_ino != (outside / 'secret').stat().st_ino
+
+def makeTarFile(path, data):
+    path.write_bytes(makeTar([('top/f', tarfile.REGTYPE, data)]).getvalue())
+    return path
+
+def runExtract(pathTar, pathOut, pathCache, **kwargs):
+    eik.run([TaskExtractTar(eik.InputTask(str(pathTar)), str(pathOut), pathCache=str(pathCache), **kwargs)])
+    return (pathOut / 'f').read_bytes()
+
+def getTrees(pathCache):
+    return sorted(p.name for p in (pathCache / 'trees').iterdir() if p.is_dir())
+
+def test_tree_cache_needs_reflink(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(extract, 'canReflink', lambda src, dest: False)
+    pathTar = makeTarFile(tmp_path / 'a.tar', b'a')
+    assert runExtract(pathTar, tmp_path / 'out', tmp_path / 'cache') == b'a'
+    assert getTrees(tmp_path / 'cache') == []
+
+def test_tree_cache_eviction(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(extract, 'canReflink', lambda src, dest: True)
+    pathCache = tmp_path / 'cache'
+    assert runExtract(makeTarFile(tmp_path / 'a.tar', b'a' * 100), tmp_path / 'a', pathCache, sizeTreeCache=150) == b'a' * 100
+    assert len(getTrees(pathCache)) == 1
+    assert runExtract(tmp_path / 'a.tar', tmp_path / 'a2', pathCache, sizeTreeCache=150) == b'a' * 100
+    assert len(getTrees(pathCache)) == 1
+    # Both together are too large: the older one goes
+    aTreeA = getTrees(pathCache)
+    assert runExtract(makeTarFile(tmp_path / 'b.tar', b'b' * 100), tmp_path / 'b', pathCache, sizeTreeCache=150) == b'b' * 100
+    aTreeB = getTrees(pathCache)
+    assert len(aTreeB) == 1 and aTreeB != aTreeA
+    assert not (pathCache / 'trees' / '{}.size'.format(aTreeA[0])).exists()
+
+def test_umask(dirs, monkeypatch):
+    dest, _ = dirs
+    monkeypatch.setattr(extract, 'getExtractUmask', lambda: 0o027)
+    fp = makeTar([('d', tarfile.DIRTYPE, None), ('f', tarfile.REGTYPE, b'x')])
+    extractTarStream(fp, dest)
+    assert (dest / 'd').stat().st_mode & 0o7777 == 0o750
+    assert (dest / 'f').stat().st_mode & 0o7777 == 0o640
+
+def test_fallback_only_for_unreadable(tmp_path, monkeypatch):
+    def fail(self, target):
+        raise e
+    monkeypatch.setattr(TaskExtractTar, 'extractInProcess', fail)
+    aRun = []
+    def runTar(self, cmd): # Pretend to be the real tar
+        aRun.append(cmd)
+        for name in ('f', 'g'):
+            (tmp_path / 'work' / name).write_bytes(b'x')
+    monkeypatch.setattr(TaskExtractTar, 'ex', runTar)
+    t = TaskExtractTar(eik.InputTask(str(tmp_path / 'a.tar')), str(tmp_path / 'out'))
+    (tmp_path / 'work').mkdir()
+
+    e = gzip.BadGzipFile('Not a gzipped file')
+    t.extract(str(tmp_path / 'work'))
+    assert len(aRun) == 1
+
+    e = OSError(errno.ENOSPC, 'No space left on device')
+    with pytest.raises(OSError):
+        t.extract(str(tmp_path / 'work'))
+    assert len(aRun) == 1
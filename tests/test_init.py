@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+from pathlib import Path
+
+import Ixal
+
+# Every submodule and every lazy name can be reached from the package
+def test_lazy():
+    sModule = {p.stem for p in Path(Ixal.__file__).parent.glob('*.py')} - {'__init__', '__main__'}
+    assert set(Ixal._aModule) == sModule
+    for name in Ixal._aModule:
+        assert getattr(Ixal, name) is importlib.import_module('Ixal.{}'.format(name))
+    for name in Ixal._mLazy:
+        assert getattr(Ixal, name) is not None
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from Ixal.latest import LatestChecker
+
+# Every package is at 1.2, the page doesn't change
+class UpstreamHandler(BaseHTTPRequestHandler):
+    etag = '"v1"'
+    lastmod = 'Sat, 01 Jan 2022 00:00:00 GMT'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        srv = self.server
+        with srv.lock:
+            srv.aRequest.append((self.path, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+            srv.nActive += 1
+            srv.nActiveMax = max(srv.nActiveMax, srv.nActive)
+        try:
+            time.sleep(srv.delay)
+            if self.headers.get('If-None-Match') == self.etag:
+                self.send_response(304)
+                self.send_header('ETag', self.etag)
+                self.end_headers()
+                return
+            data = '<h2>{} 1.2-1</h2>'.format(self.path.rsplit('/', 1)[-1]).encode('utf-8')
+            self.send_response(200)
+            self.send_header('ETag', self.etag)
+            self.send_header('Last-Modified', self.lastmod)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        finally:
+            with srv.lock:
+                srv.nActive -= 1
+
+@pytest.fixture
+def server(monkeypatch):
+    monkeypatch.setenv('NO_PROXY', '127.0.0.1')
+    srv = ThreadingHTTPServer(('127.0.0.1', 0), UpstreamHandler)
+    srv.lock = threading.Lock()
+    srv.aRequest = []
+    srv.nActive = 0
+    srv.nActiveMax = 0
+    srv.delay = 0
+    thr = threading.Thread(target=srv.serve_forever, daemon=True)
+    thr.start()
+    yield srv
+    srv.shutdown()
+    srv.server_close()
+
+def getChecker(srv, **kwargs):
+    url = 'http://127.0.0.1:{:d}/pkg/{{}}'.format(srv.server_address[1])
+    return LatestChecker(mUpstream={'test': (url, R'<h2>[^< ]+ ([^<-]+)-[^<]*</h2>')}, **kwargs)
+
+def test_ttl(server):
+    checker = getChecker(server)
+    assert checker.check('test:foo', '1.0') == '1.2'
+    assert checker.check('test:foo', '1.2') == None
+    assert len(server.aRequest) == 1
+
+def test_not_modified(server):
+    checker = getChecker(server, ttl=0)
+    assert checker.check('test:foo', '1.0') == '1.2'
+    assert checker.check('test:foo', '1.1') == '1.2'
+    assert server.aRequest == [('/pkg/foo', None, None), ('/pkg/foo', UpstreamHandler.etag, UpstreamHandler.lastmod)]
+
+def test_per_host_limit(server):
+    server.delay = 0.1
+    checker = getChecker(server, nthreads=8, nPerHost=2)
+    aRslt = list(checker.checkAll(('test:p{:d}'.format(i), '1.0', i) for i in range(8)))
+    assert sorted(aRslt) == [(i, '1.2', None) for i in range(8)]
+    assert len(server.aRequest) == 8
+    assert server.nActiveMax == 2
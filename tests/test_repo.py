@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import shutil
+import tarfile
+
+import Eikthyr as eik
+import pytest
+
+from Ixal.index import RepoIndex
+from Ixal.repo import TaskRepoAdd
+from Ixal.stream import openDecompressed
+
+def makePackage(path, name, ver, aFile):
+    textInfo = 'pkgname = {}\npkgbase = {}\npkgver = {}\npkgdesc = Test\nbuilddate = 0\npackager = Nobody\nsize = 1\narch = any\n'.format(name, name, ver)
+    with tarfile.open(path, 'w:gz') as tar:
+        for (name, data) in (('.PKGINFO', textInfo.encode('utf-8')), *((f, b'x') for f in aFile)):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return str(path)
+
+# {name: {desc, files}} in a db or files archive
+def readArchive(path):
+    mRslt = {}
+    with open(path, 'rb') as fp:
+        with openDecompressed(fp, path) as fpTar:
+            with tarfile.open(fileobj=fpTar, mode='r|') as tar:
+                for info in tar:
+                    if not info.isfile(): continue
+                    (dirname, _, key) = info.name.rpartition('/')
+                    mRslt.setdefault(dirname, {})[key] = tar.extractfile(info).read().decode('utf-8')
+    return mRslt
+
+@pytest.mark.skipif(shutil.which('zstd') == None, reason='needs zstd')
+def test_add(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    with tarfile.open(tmp_path / 'empty.files', 'w'):
+        pass
+    aPkg = [makePackage(tmp_path / 'foo-1.0-1-any.pkg.tar.gz', 'foo', '1.0-1', ('usr/bin/foo', 'usr/share/foo')),
+            makePackage(tmp_path / 'bar-2.0-1-any.pkg.tar.gz', 'bar', '2.0-1', ('usr/bin/bar',))]
+    eik.run([TaskRepoAdd(str(tmp_path / 'r.db'), str(tmp_path / 'r.files'), eik.InputTask(str(tmp_path / 'empty.files')), [eik.InputTask(f) for f in aPkg], lvl=3)])
+    mFiles = readArchive(tmp_path / 'r.files')
+    assert mFiles['foo-1.0-1']['files'] == '%FILES%\nusr/bin/foo\nusr/share/foo\n'
+    assert mFiles['bar-2.0-1']['files'] == '%FILES%\nusr/bin/bar\n'
+    assert '%NAME%\nfoo\n' in mFiles['foo-1.0-1']['desc']
+    assert list(readArchive(tmp_path / 'r.db')['foo-1.0-1']) == ['desc']
+
+    # The new version replaces the old one, and bar goes through the index untouched
+    aPkg = [makePackage(tmp_path / 'foo-1.1-1-any.pkg.tar.gz', 'foo', '1.1-1', ('usr/bin/foo2',))]
+    eik.run([TaskRepoAdd(str(tmp_path / 'r2.db'), str(tmp_path / 'r2.files'), eik.InputTask(str(tmp_path / 'r.files')), [eik.InputTask(f) for f in aPkg], lvl=3)])
+    mFiles = readArchive(tmp_path / 'r2.files')
+    assert sorted(mFiles) == ['bar-2.0-1', 'foo-1.1-1']
+    assert mFiles['foo-1.1-1']['files'] == '%FILES%\nusr/bin/foo2\n'
+    assert mFiles['bar-2.0-1']['files'] == '%FILES%\nusr/bin/bar\n'
+
+def test_index_rollback(tmp_path):
+    with pytest.raises(RuntimeError):
+        with RepoIndex(tmp_path / 'r.index') as index:
+            index.putFiles('foo-1.0-1')
+            index.addFile('foo-1.0-1', 'usr/bin/foo')
+            raise RuntimeError('Failed halfway through the package')
+    with RepoIndex(tmp_path / 'r.index') as index:
+        assert index.getSize() == 0
+        assert index.getGeneration() == 0
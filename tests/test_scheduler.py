@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from Ixal.scheduler import BuildGraph, runBuild
+
+def makeInfo(cls, name, depends=(), rebuild=None, file='r.py'):
+    return {'file': file, 'cls': cls, 'name': name, 'depends': list(depends), '_rebuild': rebuild}
+
+def test_order():
+    aInfo = [
+            makeInfo('App', 'app', ('libfoo>=1.0', 'glibc')),
+            makeInfo('Foo', ('libfoo', 'libfoo-doc'), ('zlib',)),
+            makeInfo('Zlib', 'zlib'),
+            makeInfo('Nothing', ()), # Builds no package, so it's left out
+            ]
+    graph = BuildGraph(aInfo)
+    assert len(graph) == 3
+    aName = [graph.aInfo[i]['cls'] for i in graph.getOrder()]
+    assert aName == ['Zlib', 'Foo', 'App']
+    assert graph.getDownstream(2) == {0, 1}
+
+@pytest.mark.parametrize('rebuild', ('zlib', ('zlib', 'glibc'), ['zlib']))
+def test_rebuild(rebuild):
+    graph = BuildGraph([makeInfo('Foo', 'foo', rebuild=rebuild), makeInfo('Zlib', 'zlib')])
+    assert graph.aDeps == [{1}, set()]
+    assert graph.getOrder() == [1, 0]
+
+def test_cycle():
+    aInfo = [
+            makeInfo('A', 'a', ('b',)),
+            makeInfo('B', 'b', rebuild='a'),
+            makeInfo('C', 'c', ('a',)),
+            makeInfo('D', 'd', ('d',)), # Depending on itself is fine
+            ]
+    with pytest.raises(RuntimeError) as e:
+        BuildGraph(aInfo).getOrder()
+    assert 'r.py:A' in str(e.value) and 'r.py:B' in str(e.value)
+    assert 'r.py:D' not in str(e.value)
+
+# Trivial units: each one records its name when it gets built, Fail fails
+textRecipe = '''
+import os
+class Ok(object):
+    def make(self):
+        with open(os.path.join(os.path.dirname(__file__), 'built'), 'a') as fpw:
+            fpw.write(type(self).__name__ + '\\n')
+class A(Ok): pass
+class B(Ok): pass
+class C(Ok): pass
+class D(Ok): pass
+class Fail(object):
+    def make(self):
+        raise RuntimeError('Failed on purpose')
+'''
+
+def test_run(tmp_path):
+    path = tmp_path / 'r.py'
+    path.write_text(textRecipe)
+    aInfo = [
+            makeInfo('A', 'a', file=str(path)),
+            makeInfo('B', 'b', ('a',), file=str(path)),
+            makeInfo('Fail', 'fail', ('a',), file=str(path)),
+            makeInfo('C', 'c', ('fail', 'b'), file=str(path)),
+            makeInfo('D', 'd', file=str(path)),
+            ]
+    aFailed = runBuild(BuildGraph(aInfo), nWorkers=2, nCPU=2)
+    assert [info['cls'] for info in aFailed] == ['Fail', 'C']
+    aBuilt = (tmp_path / 'built').read_text().split()
+    assert sorted(aBuilt) == ['A', 'B', 'D']
+    assert aBuilt.index('A') < aBuilt.index('B')
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Copyright 2021-2022, Hojin Koh
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import os
+import random
+import shutil
+import subprocess
+
+import Eikthyr as eik
+import pytest
+
+from Ixal.catalog import loadRecipe
+from Ixal.tidy import TaskCompressMan, TaskPostProcess, runVisitors
+
+# Something looking like a man page, this one is large enough for zlib and gzip to choose differently
+def makeManPage(seed=29):
+    r = random.Random(seed)
+    aWord = [''.join(r.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(r.randint(1, 10))) for _ in range(r.choice((300, 1000, 3000)))]
+    aLine = []
+    for _ in range(r.choice((2000, 5000))):
+        k = r.random()
+        if k < 0.1: aLine.append('.TP')
+        elif k < 0.15: aLine.append('.B ' + r.choice(aWord))
+        elif k < 0.2: aLine.append(r.choice(aLine) if aLine else 'x')
+        else: aLine.append(' '.join(r.choice(aWord) for _ in range(r.randint(3, 12))))
+    return ('\n'.join(aLine) + '\n').encode('utf-8')
+
+@pytest.mark.skipif(shutil.which('gzip') == None, reason='needs gzip')
+def test_compress_man_same_as_gzip(tmp_path, monkeypatch):
+    monkeypatch.setenv('IXAL_NUM_JOBS', '2')
+    pathMan = tmp_path / 'pkg' / 'opt' / 'share' / 'man' / 'man1'
+    pathMan.mkdir(parents=True)
+    pathRef = tmp_path / 'ref'
+    pathRef.mkdir()
+    mData = {'foo{:d}.1'.format(i): makeManPage(29 + i) for i in range(5)} # Batches of 3 and 2 pages
+    for (name, data) in mData.items():
+        (pathMan / name).write_bytes(data)
+        (pathRef / name).write_bytes(data)
+        subprocess.run(('gzip', '-n9', str(pathRef / name)), check=True)
+    os.symlink('foo0.1', pathMan / 'bar.1')
+
+    t = TaskCompressMan(eik.InputTask(str(tmp_path / 'pkg')), '/opt', pathStamp=str(tmp_path / 'stamp'))
+    runVisitors(str(tmp_path / 'pkg'), [t])
+    for (name, data) in mData.items():
+        assert not (pathMan / name).exists()
+        assert (pathMan / (name + '.gz')).read_bytes() == (pathRef / (name + '.gz')).read_bytes()
+        assert gzip.decompress((pathMan / (name + '.gz')).read_bytes()) == data
+    assert os.readlink(pathMan / 'bar.1.gz') == 'foo0.1.gz'
+
+textVisitor = '''
+from Ixal.tidy import TaskPostProcessingBase
+class TaskFoo(TaskPostProcessingBase):
+    isVisitor = True
+    def visit(self, rel, ent):
+        return {}
+'''
+
+# Editing a visitor changes the code hash of the task running it
+def test_visitor_code_hash(tmp_path):
+    aHash = []
+    for (i, val) in enumerate(('False', 'rel.endswith(".la")')):
+        path = tmp_path / 'v{:d}.py'.format(i)
+        path.write_text(textVisitor.format(val))
+        cls = loadRecipe(path, 'ixal_test_visitor{:d}'.format(i)).TaskFoo
+        t = TaskPostProcess(eik.InputTask(str(tmp_path)), '/opt', aTask=(cls,), pathStamp=str(tmp_path / 'stamp'))
+        aHash.append((t.getCodeHash(), cls(eik.InputTask(str(tmp_path)), '/opt', pathStamp=str(tmp_path / 'stamp')).getCodeHash()))
+    assert aHash[0][0] != aHash[1][0]
+    assert aHash[0][1] != aHash[1][1]